@@ -4,13 +4,13 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import gettext_lazy as _
 
-from .models import CustomUser
+from .models import CustomUser, LoginDevice, OutboxEmail
 
 class CustomUserAdmin(UserAdmin):
 
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
-        (_('Personal info'), {'fields': ('first_name', 'last_name', 'email', 'email_verified', 'customer_id')}),
+        (_('Personal info'), {'fields': ('first_name', 'last_name', 'email', 'email_verified', 'customer_id', 'subscription_status', 'subscription_expires_at')}),
         (_('Permissions'), {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')}),
         (_('Important dates'), {'fields': ('last_login', 'date_joined')}),
     )
@@ -27,3 +27,15 @@ class CustomUserAdmin(UserAdmin):
     search_fields = ('username', 'first_name', 'last_name', 'email')
 
 admin.site.register(CustomUser, CustomUserAdmin)
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'created_at', 'attempts', 'next_attempt_at', 'sent_at', 'failed_at')
+    search_fields = ('subject', )
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
+
+class LoginDeviceAdmin(admin.ModelAdmin):
+    list_display = ('user', 'ip_address', 'user_agent', 'first_seen_at', 'last_seen_at', 'notified_at')
+    search_fields = ('user__email', 'ip_address')
+
+admin.site.register(LoginDevice, LoginDeviceAdmin)
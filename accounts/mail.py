@@ -0,0 +1,120 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.utils import timezone
+
+# ===============================================
+# メールの送信キュー（アウトボックス）
+# EMAIL_BACKENDをOutboxBackendにすると、send_mail()などはDBに保存するだけになり、
+# リクエスト中にSMTP/SendGridを待たない。実際の送信はsend_queued_mailコマンドが
+# OUTBOX_EMAIL_BACKENDを使ってまとめて行う。
+# ===============================================
+class OutboxBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        from .models import OutboxEmail
+
+        emails = []
+        for message in email_messages:
+            if message.attachments:
+                raise ValueError('添付ファイル付きのメールは送信キューに入れられません。')
+
+            emails.append(OutboxEmail(
+                subject=message.subject,
+                body=message.body,
+                from_email=message.from_email,
+                recipients={'to': message.to, 'cc': message.cc, 'bcc': message.bcc, 'reply_to': message.reply_to},
+                headers=message.extra_headers,
+                alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+            ))
+
+        OutboxEmail.objects.bulk_create(emails)
+        return len(emails)
+
+def to_message(email, connection):
+    '''
+    保存したメールを送信用のメッセージに戻す
+    '''
+    recipients = email.recipients
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=recipients.get('to'),
+        cc=recipients.get('cc'),
+        bcc=recipients.get('bcc'),
+        reply_to=recipients.get('reply_to'),
+        headers=email.headers,
+        connection=connection,
+    )
+    for content, mimetype in email.alternatives:
+        message.attach_alternative(content, mimetype)
+    return message
+
+def get_retry_delay(attempts):
+    '''
+    attempts回失敗した後、次に送信するまでの秒数（指数バックオフ）
+    '''
+    return min(settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
+
+def claim_queued_mail(batch_size, now):
+    '''
+    送信予定を過ぎたメールをbatch_size件取り出し、OUTBOX_CLAIM_TIMEOUT秒の間は他のワーカーが取り出さないようにする。
+    行のロックはこの短いトランザクションの間だけで、送信中には保持しない
+    '''
+    from .models import OutboxEmail
+
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, failed_at__isnull=True, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if emails:
+            OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+                next_attempt_at=now + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT),
+            )
+    return emails
+
+def send_queued_mail(batch_size=100):
+    '''
+    送信予定を過ぎたメールをbatch_size件まとめて、1つの接続で送信し、取り出した件数を返す。
+    失敗したメールは間隔を空けて再送し、OUTBOX_MAX_ATTEMPTS回失敗したら送信をあきらめる
+    '''
+    emails = claim_queued_mail(batch_size, timezone.now())
+    if not emails:
+        return 0
+
+    connection = get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    try:
+        connection.open()
+    except Exception as e:
+        # 接続できない場合はすべて再送にまわす
+        for email in emails:
+            mark_failed(email, e, timezone.now())
+        return len(emails)
+
+    try:
+        for email in emails:
+            try:
+                connection.send_messages([to_message(email, connection)])
+            except Exception as e:
+                mark_failed(email, e, timezone.now())
+            else:
+                # 1通ずつ記録する（途中でワーカーが止まっても、送信済みのメールは再送しない）
+                email.sent_at = timezone.now()
+                email.save(update_fields=['sent_at'])
+    finally:
+        connection.close()
+
+    return len(emails)
+
+def mark_failed(email, error, now):
+    email.attempts += 1
+    email.last_error = f'{type(error).__name__}: {error}'
+    if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        email.failed_at = now
+    else:
+        email.next_attempt_at = now + timedelta(seconds=get_retry_delay(email.attempts))
+    email.save(update_fields=['attempts', 'next_attempt_at', 'last_error', 'failed_at'])
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from accounts.mail import send_queued_mail
+from accounts.notifications import queue_login_digests
+
+class Command(BaseCommand):
+    help = 'ログイン通知をまとめて送信キューに入れ、送信キューに入っているメールをまとめて送信します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='1回に送信するメールの件数')
+        parser.add_argument('--loop', action='store_true', help='終了せずに処理を続ける')
+        parser.add_argument('--interval', type=float, default=5, help='--loop時、送信するメールがない場合に待つ秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            queued = queue_login_digests()
+            if queued:
+                self.stdout.write(f'{queued}件のログイン通知を送信キューに入れました。')
+
+            # 送信予定を過ぎたメールがなくなるまで送信する
+            total = 0
+            while True:
+                processed = send_queued_mail(options['batch_size'])
+                total += processed
+                if processed < options['batch_size']:
+                    break
+
+            if total:
+                self.stdout.write(f'{total}件のメールを処理しました。')
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='subscription_expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='subscription state expires at'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscription_status',
+            field=models.CharField(blank=True, max_length=30, null=True, verbose_name='subscription status'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:29
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_customuser_subscription_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='subject')),
+                ('body', models.TextField(verbose_name='body')),
+                ('from_email', models.CharField(max_length=255, verbose_name='from email')),
+                ('recipients', models.JSONField(verbose_name='recipients')),
+                ('headers', models.JSONField(default=dict, verbose_name='headers')),
+                ('alternatives', models.JSONField(default=list, verbose_name='alternatives')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='next attempt at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='sent at')),
+                ('failed_at', models.DateTimeField(blank=True, null=True, verbose_name='failed at')),
+            ],
+            options={
+                'verbose_name': 'outbox email',
+                'verbose_name_plural': 'outbox emails',
+                'indexes': [models.Index(fields=['sent_at', 'failed_at', 'next_attempt_at'], name='outboxemail_pending_idx')],
+            },
+        ),
+    ]
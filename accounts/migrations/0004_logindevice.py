@@ -0,0 +1,35 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_outboxemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginDevice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_hash', models.CharField(max_length=64, verbose_name='device hash')),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True, verbose_name='IP address')),
+                ('user_agent', models.CharField(blank=True, max_length=255, verbose_name='user agent')),
+                ('first_seen_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='first seen at')),
+                ('last_seen_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='last seen at')),
+                ('notified_at', models.DateTimeField(blank=True, null=True, verbose_name='notified at')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='login_devices', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'login device',
+                'verbose_name_plural': 'login devices',
+                'indexes': [models.Index(fields=['notified_at', 'user'], name='logindevice_notified_idx')],
+                'unique_together': {('user', 'device_hash')},
+            },
+        ),
+    ]
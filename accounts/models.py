@@ -41,6 +41,10 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     customer_id = models.CharField(_('customer id'), max_length=150, blank=True, null=True)
 
+    # Stripeのサブスクリプションの状態のキャッシュ。subscription_expires_atを過ぎたらStripeに問い合わせ直す
+    subscription_status = models.CharField(_('subscription status'), max_length=30, blank=True, null=True)
+    subscription_expires_at = models.DateTimeField(_('subscription state expires at'), blank=True, null=True)
+
 
     is_staff    = models.BooleanField(
                     _('staff status'),
@@ -88,6 +92,74 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         """Return the short name for the user."""
         return self.first_name
 
+    def is_subscription_state_expired(self):
+        """Return True if the cached subscription state must be refreshed."""
+        return self.subscription_expires_at is None or self.subscription_expires_at <= timezone.now()
+
+    def has_active_subscription(self):
+        """Return True if the cached subscription state is active."""
+        return bool(self.customer_id) and self.subscription_status == 'active'
+
     def email_user(self, subject, message, from_email=None, **kwargs):
         """Send an email to this user."""
         send_mail(subject, message, from_email, [self.email], **kwargs)
+
+
+class OutboxEmail(models.Model):
+    """
+    Email queued by accounts.mail.OutboxBackend and sent by the send_queued_mail command.
+    """
+
+    subject     = models.CharField(_('subject'), max_length=255)
+    body        = models.TextField(_('body'))
+    from_email  = models.CharField(_('from email'), max_length=255)
+    # to/cc/bcc/reply_toのリスト、ヘッダー、HTMLなどの代替本文をまとめて保存する
+    recipients  = models.JSONField(_('recipients'))
+    headers     = models.JSONField(_('headers'), default=dict)
+    alternatives = models.JSONField(_('alternatives'), default=list)
+
+    created_at      = models.DateTimeField(_('created at'), auto_now_add=True)
+    next_attempt_at = models.DateTimeField(_('next attempt at'), default=timezone.now)
+    attempts        = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error      = models.TextField(_('last error'), blank=True)
+    sent_at         = models.DateTimeField(_('sent at'), blank=True, null=True)
+    failed_at       = models.DateTimeField(_('failed at'), blank=True, null=True)
+
+    class Meta:
+        verbose_name = _('outbox email')
+        verbose_name_plural = _('outbox emails')
+        indexes = [
+            # 未送信のメールを送信予定順に取り出す用
+            models.Index(fields=['sent_at', 'failed_at', 'next_attempt_at'], name='outboxemail_pending_idx'),
+        ]
+
+    def __str__(self):
+        return self.subject
+
+
+class LoginDevice(models.Model):
+    """
+    Device (IP address and user agent) a user has logged in from, used for login notifications.
+    """
+
+    user        = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='login_devices')
+    # IPアドレスとユーザーエージェントのハッシュ。同じ端末からのログインは1行にまとめる
+    device_hash = models.CharField(_('device hash'), max_length=64)
+    ip_address  = models.GenericIPAddressField(_('IP address'), blank=True, null=True)
+    user_agent  = models.CharField(_('user agent'), max_length=255, blank=True)
+
+    first_seen_at   = models.DateTimeField(_('first seen at'), default=timezone.now)
+    last_seen_at    = models.DateTimeField(_('last seen at'), default=timezone.now)
+    # 通知メールに含めた日時。未通知の端末はまとめて1通で通知する
+    notified_at     = models.DateTimeField(_('notified at'), blank=True, null=True)
+
+    class Meta:
+        verbose_name = _('login device')
+        verbose_name_plural = _('login devices')
+        unique_together = ('user', 'device_hash')
+        indexes = [
+            models.Index(fields=['notified_at', 'user'], name='logindevice_notified_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} {self.ip_address}'
@@ -0,0 +1,84 @@
+import hashlib
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.core.validators import validate_ipv46_address
+from django.utils import timezone
+from .models import LoginDevice
+
+# ===============================================
+# ログインのセキュリティ通知
+# ログインのたびにメールを送らず、端末（IPアドレス+ユーザーエージェント）ごとに記録しておき、
+# 初めての端末だけをユーザーごとに1通にまとめて通知する（LOGIN_NOTIFICATION_WINDOW秒に1通まで）。
+# ===============================================
+def get_device_hash(ip_address, user_agent):
+    return hashlib.sha256(f'{ip_address}\n{user_agent}'.encode()).hexdigest()
+
+def record_login(user, ip_address, user_agent):
+    '''
+    ログインした端末を記録する。既知の端末の場合、最終ログイン日時は一定間隔でしか更新しない
+    '''
+    now = timezone.now()
+    ip_address = (ip_address or '').strip()
+    try:
+        validate_ipv46_address(ip_address)
+    except ValidationError:
+        ip_address = None
+    user_agent = (user_agent or '')[:255]
+    device_hash = get_device_hash(ip_address, user_agent)
+
+    last_seen_at = LoginDevice.objects.filter(user=user, device_hash=device_hash).values_list('last_seen_at', flat=True).first()
+    if last_seen_at is None:
+        # 初めての端末。同時にログインしても1行だけになる
+        LoginDevice.objects.bulk_create(
+            [LoginDevice(user=user, device_hash=device_hash, ip_address=ip_address, user_agent=user_agent, first_seen_at=now, last_seen_at=now)],
+            ignore_conflicts=True,
+        )
+    elif last_seen_at < now - timedelta(seconds=settings.LOGIN_NOTIFICATION_WINDOW):
+        LoginDevice.objects.filter(user=user, device_hash=device_hash).update(last_seen_at=now)
+
+def queue_login_digests():
+    '''
+    未通知の端末があるユーザーに通知メールを1通ずつ送信キューに入れ、通知したユーザー数を返す。
+    直近LOGIN_NOTIFICATION_WINDOW秒以内に通知したユーザーは次の機会にまわす
+    '''
+    now = timezone.now()
+    recently_notified = LoginDevice.objects.filter(notified_at__gte=now - timedelta(seconds=settings.LOGIN_NOTIFICATION_WINDOW)).values('user')
+
+    with transaction.atomic():
+        devices = list(
+            LoginDevice.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(notified_at__isnull=True)
+            .exclude(user__in=recently_notified)
+            .select_related('user')
+            .order_by('user', 'first_seen_at')
+        )
+
+        devices_by_user = defaultdict(list)
+        for device in devices:
+            devices_by_user[device.user].append(device)
+
+        messages = [build_digest(user, user_devices) for user, user_devices in devices_by_user.items()]
+        if messages:
+            get_connection().send_messages(messages)
+
+        LoginDevice.objects.filter(pk__in=[device.pk for device in devices]).update(notified_at=now)
+
+    return len(messages)
+
+def build_digest(user, devices):
+    body = "ご利用ありがとうございます。下記端末でログインされました。\n\n"
+    for device in devices:
+        body += f"日時: {timezone.localtime(device.first_seen_at):%Y-%m-%d %H:%M}\n"
+        body += f"IPアドレス: {device.ip_address}\n"
+        body += f"ユーザーエージェント: {device.user_agent}\n\n"
+
+    return EmailMessage(
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[ user.email ],
+        subject="セキュリティ通知",
+        body=body,
+    )
@@ -1,7 +1,6 @@
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.dispatch import receiver
-from django.conf import settings
-from django.core.mail import EmailMessage
+from .notifications import record_login
 
 @receiver(user_logged_in)
 def user_logged_in_callback(sender, request, user, **kwargs):
@@ -17,19 +16,8 @@ def user_logged_in_callback(sender, request, user, **kwargs):
 
     user_agent  = request.META.get('HTTP_USER_AGENT')
 
-
-    body = "ご利用ありがとうございます。下記端末でログインされました。\n\n"
-    body += f"IPアドレス: {ip}\n"
-    body += f"ユーザーエージェント: {user_agent}\n\n"
-
-    msg = EmailMessage(
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[ request.user.email ],
-            subject ="セキュリティ通知",
-            body=body,
-          )
-
-    msg.send(fail_silently=False)
+    # 端末を記録するだけ。初めての端末の通知メールは send_queued_mail コマンドがまとめて送る
+    record_login(user, ip, user_agent)
 
     print(f'{user.username}がログインしました。')
 
@@ -1,3 +1,128 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from .mail import send_queued_mail
+from .models import LoginDevice, OutboxEmail
+from .notifications import queue_login_digests, record_login
 
-# Create your tests here.
+User = get_user_model()
+
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server is unavailable')
+
+
+class RecordingBackend(BaseEmailBackend):
+    '''
+    送信時のトランザクションの深さ、送信済みの件数、他のワーカーが取り出せる件数を記録する
+    '''
+    sends = []
+
+    def send_messages(self, email_messages):
+        RecordingBackend.sends.append({
+            'atomic_blocks': len(connection.atomic_blocks),
+            'sent': OutboxEmail.objects.filter(sent_at__isnull=False).count(),
+            'claimable': OutboxEmail.objects.filter(sent_at__isnull=True, failed_at__isnull=True, next_attempt_at__lte=timezone.now()).count(),
+        })
+        return len(email_messages)
+
+
+# ===============================================
+# メールの送信キュー
+# ===============================================
+@override_settings(
+    EMAIL_BACKEND='accounts.mail.OutboxBackend',
+    OUTBOX_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    OUTBOX_MAX_ATTEMPTS=2,
+    OUTBOX_RETRY_DELAY=60,
+)
+class OutboxTests(TestCase):
+    def test_send_mail_is_queued_until_the_worker_runs(self):
+        mail.send_mail('件名', '本文', 'from@example.com', ['to@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_queued_mail(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['to@example.com'])
+        self.assertIsNotNone(OutboxEmail.objects.get().sent_at)
+        self.assertEqual(send_queued_mail(), 0)
+
+    def test_login_does_not_send_mail_in_the_request(self):
+        User.objects.create_user(username='user', email='user@example.com', password='password')
+
+        self.client.post('/accounts/login/', {'username': 'user@example.com', 'password': 'password'})
+        self.assertEqual(len(mail.outbox), 0)
+
+        queue_login_digests()
+        self.assertEqual(OutboxEmail.objects.filter(recipients__to=['user@example.com']).count(), 1)
+
+    @override_settings(OUTBOX_EMAIL_BACKEND='accounts.tests.FailingBackend')
+    def test_failed_mail_is_retried_with_backoff_then_given_up(self):
+        mail.send_mail('件名', '本文', 'from@example.com', ['to@example.com'])
+
+        send_queued_mail()
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNone(email.sent_at)
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertIn('SMTP server is unavailable', email.last_error)
+
+        # 再送予定まではキューから取り出さない
+        self.assertEqual(send_queued_mail(), 0)
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        send_queued_mail()
+        self.assertIsNotNone(OutboxEmail.objects.get().failed_at)
+
+    @override_settings(OUTBOX_EMAIL_BACKEND='accounts.tests.RecordingBackend')
+    def test_mail_is_sent_outside_the_claim_transaction(self):
+        mail.send_mail('件名1', '本文', 'from@example.com', ['to@example.com'])
+        mail.send_mail('件名2', '本文', 'from@example.com', ['to@example.com'])
+        RecordingBackend.sends = []
+
+        atomic_blocks = len(connection.atomic_blocks)
+        self.assertEqual(send_queued_mail(), 2)
+
+        # 送信中はトランザクション（行ロック）の外で、取り出したメールは他のワーカーが取り出さない。
+        # 送信済みは1通ずつ記録される
+        self.assertEqual(RecordingBackend.sends, [
+            {'atomic_blocks': atomic_blocks, 'sent': 0, 'claimable': 0},
+            {'atomic_blocks': atomic_blocks, 'sent': 1, 'claimable': 0},
+        ])
+        self.assertEqual(OutboxEmail.objects.filter(sent_at__isnull=True).count(), 0)
+
+
+# ===============================================
+# ログインのセキュリティ通知
+# ===============================================
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', LOGIN_NOTIFICATION_WINDOW=60 * 15)
+class LoginNotificationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+
+    def test_repeated_logins_from_one_device_are_one_row(self):
+        for _ in range(3):
+            record_login(self.user, '192.0.2.1', 'Browser')
+        self.assertEqual(LoginDevice.objects.count(), 1)
+
+    def test_new_devices_are_sent_as_one_digest_per_window(self):
+        record_login(self.user, '192.0.2.1', 'Browser')
+        record_login(self.user, '192.0.2.2', 'Phone')
+        self.assertEqual(queue_login_digests(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('192.0.2.2', mail.outbox[0].body)
+
+        # 既知の端末は通知しない。新しい端末は時間をおいてから通知する
+        record_login(self.user, '192.0.2.1', 'Browser')
+        record_login(self.user, '192.0.2.3', 'Tablet')
+        self.assertEqual(queue_login_digests(), 0)
+
+        LoginDevice.objects.exclude(notified_at=None).update(notified_at=timezone.now() - timedelta(minutes=16))
+        self.assertEqual(queue_login_digests(), 1)
+        self.assertIn('192.0.2.3', mail.outbox[1].body)
+        self.assertNotIn('192.0.2.1', mail.outbox[1].body)
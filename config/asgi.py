@@ -9,8 +9,64 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
+from asgiref.sync import sync_to_async
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class StaticFilesApplication:
+    '''
+    静的ファイルをDjangoのミドルウェアを通さずに配信するASGIアプリケーション。
+    WhiteNoiseMiddlewareは同期専用で、MIDDLEWAREに入れるとASGIでもリクエストごとにスレッドで処理されるため、
+    WhiteNoiseはファイルの検索とヘッダーの作成だけに使い、ファイルはスレッドで少しずつ読み込んで送信する
+    '''
+    chunk_size = 64 * 1024
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = WhiteNoiseMiddleware()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            static_file = self.find_file(scope['path'])
+            if static_file is not None:
+                await self.serve(static_file, scope, send)
+                return
+        await self.application(scope, receive, send)
+
+    def find_file(self, path):
+        if self.whitenoise.autorefresh:
+            return self.whitenoise.find_file(path)
+        return self.whitenoise.files.get(path)
+
+    async def serve(self, static_file, scope, send):
+        # WhiteNoiseにはWSGIのenvironと同じ形式でリクエストヘッダーを渡す
+        request_headers = {
+            'HTTP_' + name.decode('latin1').upper().replace('-', '_'): value.decode('latin1')
+            for name, value in scope['headers']
+        }
+        response = await sync_to_async(static_file.get_response, thread_sensitive=False)(scope['method'], request_headers)
+        await send({
+            'type': 'http.response.start',
+            'status': int(response.status),
+            'headers': [(key.lower().encode('latin1'), value.encode('latin1')) for key, value in response.headers],
+        })
+        if response.file is None:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        read = sync_to_async(response.file.read, thread_sensitive=False)
+        try:
+            while chunk := await read(self.chunk_size):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await sync_to_async(response.file.close, thread_sensitive=False)()
+
+
+application = StaticFilesApplication(django_application)
@@ -46,14 +46,27 @@ INSTALLED_APPS = [
 ]
 
 
+# メールはDBの送信キューに入れ、send_queued_mailコマンドが OUTBOX_EMAIL_BACKEND で送信する
+EMAIL_BACKEND = 'accounts.mail.OutboxBackend'
+
+# 送信に失敗したメールの再送の設定（1回目の待ち秒数。以降は倍にしていき、最大でOUTBOX_MAX_RETRY_DELAY秒）
+OUTBOX_MAX_ATTEMPTS     = 5
+OUTBOX_RETRY_DELAY      = 60
+OUTBOX_MAX_RETRY_DELAY  = 60 * 60
+# 取り出したメールを他のワーカーが取り出さない秒数（送信中にワーカーが止まった場合は、この後に再送される）
+OUTBOX_CLAIM_TIMEOUT    = 60 * 10
+
+# ログインのセキュリティ通知は、この秒数に1通までにまとめる（既知の端末は通知しない）
+LOGIN_NOTIFICATION_WINDOW = 60 * 15
+
 # DEBUGがTrueのとき、メールの内容はすべて端末に表示させる
 if DEBUG:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 else:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
     """
-    EMAIL_BACKEND = 'sendgrid_backend.SendGridBackend'
+    OUTBOX_EMAIL_BACKEND = 'sendgrid_backend.SendGridBackend'
     DEFAULT_FROM_EMAIL  = "example@example.com" # Sendgrid送信用のメールアドレス。
     SENDGRID_API_KEY    = "ここにsendgridのAPIkeyを記述する" # 環境変数でも可
     SENDGRID_SANDBOX_MODE_IN_DEBUG = False
@@ -70,6 +83,7 @@ ACCOUNT_FORMS   = { "signup":"accounts.forms.SignupForm"}
 
 
 MIDDLEWARE = [
+    'nagoyameshi.middleware.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,6 +91,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'nagoyameshi.middleware.PageCacheMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -93,6 +108,8 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'nagoyameshi.custom_context.categories_list',
+                'nagoyameshi.custom_context.fragment_cache',
+                'nagoyameshi.custom_context.favorites',
             ],
         },
     },
@@ -174,6 +191,78 @@ if "STRIPE_PUBLISHABLE_KEY" in os.environ and "STRIPE_API_KEY" in os.environ and
     STRIPE_API_KEY          = os.environ["STRIPE_API_KEY"]
     STRIPE_PRICE_ID         = os.environ["STRIPE_PRICE_ID"]
 
+# webhookの署名検証用のシークレット
+STRIPE_WEBHOOK_SECRET   = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
+
+# Stripe APIのクライアント。テストでは nagoyameshi.subscriptions.FakeStripeClient に差し替える
+STRIPE_CLIENT           = "nagoyameshi.subscriptions.StripeClient"
+
+# ユーザーに記録したサブスクの状態を、Stripeに問い合わせ直さずに使う秒数
+SUBSCRIPTION_STATE_TTL  = 60 * 60
+
+
+
+# キャッシュの設定
+# CACHE_BACKEND で切り替える（未指定ならプロセスごとのメモリ）
+#   locmem : プロセスごとのメモリ（ワーカー間では共有されない）
+#   file   : CACHE_LOCATION のディレクトリ（同じサーバーのワーカー間で共有）
+#   redis  : CACHE_LOCATION のRedis互換サーバー（redisパッケージが必要）
+CACHE_BACKEND   = os.environ.get("CACHE_BACKEND", "locmem")
+CACHE_BACKENDS  = {
+    "locmem": ("django.core.cache.backends.locmem.LocMemCache", "nagoyameshi"),
+    "file"  : ("django.core.cache.backends.filebased.FileBasedCache", str(BASE_DIR / ".cache")),
+    "redis" : ("django.core.cache.backends.redis.RedisCache", "redis://127.0.0.1:6379/0"),
+}
+
+CACHES = {
+    'default': {
+        'BACKEND'   : CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION'  : os.environ.get("CACHE_LOCATION", CACHE_BACKENDS[CACHE_BACKEND][1]),
+        'TIMEOUT'   : 60 * 60 * 24,
+        'KEY_PREFIX': 'nagoyameshi',
+    }
+}
+
+# テンプレートの断片キャッシュ（店舗カード/店舗情報）の有効秒数。キーは店舗の更新日時で変わる
+FRAGMENT_CACHE_TIMEOUT  = 60 * 60 * 24
+
+# ページ全体をキャッシュするページ（未ログイン/無料会員向け）と有効秒数
+PAGE_CACHE_URL_NAMES    = ['nagoyameshi:index', 'nagoyameshi:premium']
+PAGE_CACHE_TIMEOUT      = 60 * 10
+
+# リクエストごとのSQLの計測（QueryMetricsMiddleware）
+#   QUERY_COUNT_THRESHOLD      : 1リクエストのクエリ数がこれを超えたら警告のログを出す
+#   QUERY_DUPLICATE_THRESHOLD  : 同じクエリ（N+1の候補）の実行回数がこれを超えたら警告のログを出す
+#   QUERY_METRICS_SERVER_TIMING: 1ならServer-Timingヘッダーにクエリ数/DB時間を出す（内部の情報なので本番では必要なときだけ）
+#   QUERY_METRICS_LOG_LEVEL    : DEBUGにするとすべてのリクエストのログを出す（既定はしきい値を超えたときの警告だけ）
+QUERY_COUNT_THRESHOLD       = int(os.environ.get("QUERY_COUNT_THRESHOLD", 20))
+QUERY_DUPLICATE_THRESHOLD   = int(os.environ.get("QUERY_DUPLICATE_THRESHOLD", 3))
+QUERY_METRICS_SERVER_TIMING = os.environ.get("QUERY_METRICS_SERVER_TIMING") == "1"
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'nagoyameshi.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get("QUERY_METRICS_LOG_LEVEL", "WARNING"),
+            'propagate': False,
+        },
+    },
+}
+
+# DBの接続設定（本番のPostgreSQL用。環境変数で切り替える）
+#   DB_CONN_MAX_AGE : 接続を使い回す秒数。0ならリクエストごとに接続し直す。
+#                     ASGI(uvicorn)ではリクエストごとに別のスレッドで接続するため使い回されない。0のままにし、
+#                     接続の使い回しはPgBouncerで行う（WSGI(gunicorn)で動かす場合だけ600などを指定する）
+#   DB_PGBOUNCER    : 1ならPgBouncerのトランザクションモード経由で接続する
+#                     （トランザクションをまたぐサーバーサイドカーソル/プリペアドステートメントを使わない）
+DB_CONN_MAX_AGE     = int(os.environ.get("DB_CONN_MAX_AGE", 0))
+DB_PGBOUNCER        = os.environ.get("DB_PGBOUNCER") == "1"
+
 
 
 
@@ -188,16 +277,18 @@ if not DEBUG:
 
     SECRET_KEY = os.environ["SECRETKEY"]
     
-    # 静的ファイル配信ミドルウェア、whitenoiseを使用。※ 順番不一致だと動かないため下記をそのままコピーする。
+    # 静的ファイルはwhitenoiseで配信するが、ミドルウェアには入れずconfig/asgi.py(wsgi.py)でDjangoの手前に置く。
+    # WhiteNoiseMiddlewareは同期専用で、MIDDLEWAREに入れるとASGIでもリクエストごとにスレッドで処理されるため。
     MIDDLEWARE = [ 
+        'nagoyameshi.middleware.QueryMetricsMiddleware',
         'django.middleware.security.SecurityMiddleware',
-        'whitenoise.middleware.WhiteNoiseMiddleware',
         'django.contrib.sessions.middleware.SessionMiddleware',
         'django.middleware.common.CommonMiddleware',
         'django.middleware.csrf.CsrfViewMiddleware',
         'django.contrib.auth.middleware.AuthenticationMiddleware',
         'django.contrib.messages.middleware.MessageMiddleware',
         'django.middleware.clickjacking.XFrameOptionsMiddleware',
+        'nagoyameshi.middleware.PageCacheMiddleware',
         ]
 
     # 静的ファイル(static)の存在場所を指定する。
@@ -206,7 +297,7 @@ if not DEBUG:
     # DBの設定
     DATABASES = { 
             'default': {
-                'ENGINE': 'django.db.backends.postgresql_psycopg2',
+                'ENGINE': 'django.db.backends.postgresql',
                 'NAME'    : os.environ["DB_NAME"],
                 'USER'    : os.environ["DB_USER"],
                 'PASSWORD': os.environ["DB_PASSWORD"],
@@ -218,8 +309,20 @@ if not DEBUG:
     #DBのアクセス設定
     import dj_database_url
 
-    db_from_env = dj_database_url.config(conn_max_age=600, ssl_require=True)
+    db_from_env = dj_database_url.config(conn_max_age=DB_CONN_MAX_AGE, conn_health_checks=True, ssl_require=True)
     DATABASES['default'].update(db_from_env)
+
+    # DB_CONN_MAX_AGE秒まで接続を使い回す。切れた接続はリクエストの最初に確認して張り直す
+    DATABASES['default']['CONN_MAX_AGE'] = DB_CONN_MAX_AGE
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+    DATABASES['default'].setdefault('OPTIONS', {})
+
+    if DB_PGBOUNCER:
+        # トランザクションごとに別のサーバー接続になるので、トランザクションをまたぐ状態を持たない
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+        from importlib.util import find_spec
+        if find_spec('psycopg'):
+            DATABASES['default']['OPTIONS']['prepare_threshold'] = None
     
 
     #cloudinaryの設定
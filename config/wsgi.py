@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
+from whitenoise import WhiteNoise
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# 静的ファイルはDjangoのミドルウェアを通さずに配信する（ASGIではconfig/asgi.pyで配信する）
+application = WhiteNoise(application, root=settings.STATIC_ROOT, prefix=settings.STATIC_URL)
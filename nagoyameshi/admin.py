@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import ExtendedModel, Category, Day, Restaurant, RestaurantPhoto, Review
+from .models import ExtendedModel, Category, Day, Restaurant, RestaurantPhoto, Review, StripeEvent
 from django.utils.safestring import mark_safe
+from .thumbnails import get_thumbnail_url
 
 admin.site.register(ExtendedModel)
 
@@ -35,7 +36,8 @@ class RestaurantPhotoAdmin(admin.ModelAdmin):
     list_display = ('image_view', 'restaurant_id')
 
     def image_view(self, obj):
-        return mark_safe('<img src="{}" style="width:100px height:auto;">'.format(obj.image.url))
+        # 一覧では元画像ではなく最小のサムネイルを表示する
+        return mark_safe('<img src="{}" style="width:100px height:auto;">'.format(get_thumbnail_url(obj, 100)))
 
 admin.site.register(RestaurantPhoto, RestaurantPhotoAdmin)
 
@@ -44,4 +46,11 @@ class ReviewAdmin(admin.ModelAdmin):
     list_display = ('restaurant_id', 'user_id', 'comment', 'deleted_at', 'updated_at', 'created_at')
     list_filter = ('restaurant_id', 'user_id')
 
-admin.site.register(Review, ReviewAdmin)
\ No newline at end of file
+admin.site.register(Review, ReviewAdmin)
+
+# Stripeのwebhookイベント
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'type', 'stripe_created', 'created_at', 'processed_at', 'error')
+    list_filter = ('type', )
+
+admin.site.register(StripeEvent, StripeEventAdmin)
\ No newline at end of file
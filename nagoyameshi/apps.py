@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class NagoyameshiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'nagoyameshi'
+
+    def ready(self):
+        import nagoyameshi.signals
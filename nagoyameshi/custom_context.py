@@ -1,6 +1,84 @@
-from .models import Category
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from .models import Category, Favorite
+
+# カテゴリ一覧はすべてのページで使うので、プロセス内と共有キャッシュに保持する
+# （Categoryの保存/削除時にシグナルで破棄する）
+CATEGORIES_CACHE_KEY = 'nagoyameshi:categories_list'
+CATEGORIES_CACHE_TIMEOUT = 60 * 60 * 24
+# 他のプロセスでの変更を反映するまでの、プロセス内キャッシュの有効期間（秒）
+CATEGORIES_LOCAL_TIMEOUT = 30
+
+_local_categories = None
+_local_expires_at = 0
+
+def get_categories():
+    '''
+    カテゴリ一覧（プロセス内 → 共有キャッシュ → DBの順に探す）
+    '''
+    global _local_categories, _local_expires_at
+
+    now = time.monotonic()
+    if _local_categories is not None and now < _local_expires_at:
+        return _local_categories
+
+    categories = cache.get(CATEGORIES_CACHE_KEY)
+    if categories is None:
+        categories = list(Category.objects.order_by('pk'))
+        cache.set(CATEGORIES_CACHE_KEY, categories, CATEGORIES_CACHE_TIMEOUT)
+
+    _local_categories = categories
+    _local_expires_at = now + CATEGORIES_LOCAL_TIMEOUT
+    return categories
+
+def clear_categories_cache():
+    '''
+    カテゴリ一覧のキャッシュを破棄する
+    '''
+    global _local_categories
+    _local_categories = None
+    cache.delete(CATEGORIES_CACHE_KEY)
+
+# ユーザーごとのお気に入りの店舗IDの集合。一覧ページのお気に入り表示に使う
+# （Favoriteの保存/削除時にシグナルで破棄する）
+FAVORITES_CACHE_KEY = 'nagoyameshi:favorites:{}'
+FAVORITES_CACHE_TIMEOUT = 60 * 60
+
+def get_favorite_ids(user):
+    '''
+    ユーザーのお気に入りの店舗IDの集合（共有キャッシュ → DBの順に探す）
+    '''
+    if not user.is_authenticated:
+        return frozenset()
+
+    cache_key = FAVORITES_CACHE_KEY.format(user.pk)
+    favorite_ids = cache.get(cache_key)
+    if favorite_ids is None:
+        favorite_ids = frozenset(Favorite.objects.filter(user_id=user).values_list('restaurant_id', flat=True))
+        cache.set(cache_key, favorite_ids, FAVORITES_CACHE_TIMEOUT)
+    return favorite_ids
+
+def clear_favorites_cache(user_id):
+    '''
+    ユーザーのお気に入りの店舗IDのキャッシュを破棄する
+    '''
+    cache.delete(FAVORITES_CACHE_KEY.format(user_id))
 
 def categories_list(request):
     context = {}
-    context["CATEGORIES_LIST"] = Category.objects.all()
-    return context
\ No newline at end of file
+    context["CATEGORIES_LIST"] = get_categories()
+    return context
+
+def fragment_cache(request):
+    context = {}
+    context["FRAGMENT_CACHE_TIMEOUT"] = settings.FRAGMENT_CACHE_TIMEOUT
+    return context
+
+def favorites(request):
+    context = {}
+    # テンプレートで使われたときに1度だけ読み込む（お気に入り機能は有料会員のみ）
+    user = request.user
+    context["FAVORITE_RESTAURANT_IDS"] = SimpleLazyObject(lambda: get_favorite_ids(user) if getattr(user, 'customer_id', None) else frozenset())
+    return context
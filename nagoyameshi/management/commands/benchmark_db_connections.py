@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test import Client
+
+class Command(BaseCommand):
+    help = '接続を毎回作り直す場合と現在のDB接続設定で、ASGIアプリケーションへのリクエストの処理時間と接続にかかった時間を比べます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='設定ごとのリクエスト数')
+        parser.add_argument('--path', default='/top/', help='リクエストするURL')
+        parser.add_argument('--host', default='localhost', help='リクエストのHostヘッダー（ALLOWED_HOSTSに含まれるもの）')
+        parser.add_argument('--conn-max-age', type=int, help='比べるCONN_MAX_AGE（未指定なら現在の設定）')
+        parser.add_argument('--username', help='ログインしてリクエストする場合のユーザー名')
+
+    def handle(self, *args, **options):
+        headers = [(b'host', options['host'].encode())]
+        if options['username']:
+            user = get_user_model().objects.filter(username=options['username']).first()
+            if user is None:
+                raise CommandError(f'ユーザーが見つかりません: {options["username"]}')
+            # ログイン済みのセッションのCookieを付けてリクエストする
+            client = Client()
+            client.force_login(user)
+            session_id = client.cookies[settings.SESSION_COOKIE_NAME].value
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_id}'.encode()))
+
+        connection = connections[DEFAULT_DB_ALIAS]
+        configured = connection.settings_dict['CONN_MAX_AGE']
+        if options['conn_max_age'] is not None:
+            configured = options['conn_max_age']
+
+        results = [
+            ('接続し直す（CONN_MAX_AGE=0）', self.run(connection, 0, headers, options)),
+            (f'接続を使い回す（CONN_MAX_AGE={configured}）', self.run(connection, configured, headers, options)),
+        ]
+        for label, (elapsed, connects, connect_time) in results:
+            self.stdout.write(
+                f'{label}: 1リクエスト平均 {elapsed / options["requests"] * 1000:.2f}ms / '
+                f'新しい接続 {connects}回 / 接続にかかった時間 {connect_time * 1000:.1f}ms'
+            )
+
+    def run(self, connection, conn_max_age, headers, options):
+        '''
+        uvicornなどと同じく、ASGIアプリケーション（ASGIHandler）にリクエストする。
+        同期のビュー/ミドルウェアはリクエストごとに別のスレッドで動くので、すべてのスレッドの接続を数える
+        '''
+        application = get_asgi_application()
+        connection.close()
+        conn_max_age_before = connection.settings_dict['CONN_MAX_AGE']
+        # 各スレッドの接続も同じ設定(settings_dict)から作られる
+        connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+
+        stats = {'connects': 0, 'time': 0}
+        lock = threading.Lock()
+        wrapper_class = type(connection)
+        connect = wrapper_class.connect
+        def timed_connect(wrapper):
+            start = time.perf_counter()
+            connect(wrapper)
+            with lock:
+                stats['connects'] += 1
+                stats['time'] += time.perf_counter() - start
+
+        try:
+            # キャッシュを温めておく
+            asyncio.run(self.request(application, headers, options['path']))
+
+            wrapper_class.connect = timed_connect
+            start = time.perf_counter()
+            asyncio.run(self.requests(application, headers, options))
+            elapsed = time.perf_counter() - start
+        finally:
+            wrapper_class.connect = connect
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = conn_max_age_before
+
+        return elapsed, stats['connects'], stats['time']
+
+    async def requests(self, application, headers, options):
+        for _ in range(options['requests']):
+            await self.request(application, headers, options['path'])
+
+    async def request(self, application, headers, path):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': b'', 'root_path': '', 'headers': headers,
+            'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(timeout=30)
+        if start['status'] != 200:
+            raise CommandError(f'{path}: ステータス {start["status"]}')
+        # 本文を最後まで受け取る（レスポンスの終了時にDjangoが古い接続を閉じる）
+        while (await communicator.receive_output(timeout=30)).get('more_body'):
+            pass
+        await communicator.wait(timeout=30)
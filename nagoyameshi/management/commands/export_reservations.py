@@ -0,0 +1,28 @@
+import csv
+import sys
+from datetime import date
+from django.core.management.base import BaseCommand
+from nagoyameshi.models import Reservation
+from nagoyameshi.reservation_export import export_rows, filter_reservations
+
+class Command(BaseCommand):
+    help = '予約をCSVファイルに書き出します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='書き出すファイル（省略時は標準出力）')
+        parser.add_argument('--restaurant', type=int, help='店舗ID')
+        parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help='予約日の開始（YYYY-MM-DD）')
+        parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help='予約日の終了（YYYY-MM-DD、この日を含む）')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='1回に読み込む件数')
+
+    def handle(self, *args, **options):
+        reservations = filter_reservations(Reservation.objects.all(), options['restaurant'], options['date_from'], options['date_to'])
+
+        file = sys.stdout if options['path'] == '-' else open(options['path'], 'w', encoding='utf-8-sig', newline='')
+        try:
+            writer = csv.writer(file)
+            for row in export_rows(reservations, options['chunk_size']):
+                writer.writerow(row)
+        finally:
+            if file is not sys.stdout:
+                file.close()
@@ -0,0 +1,25 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from nagoyameshi.models import Restaurant
+from nagoyameshi.restaurant_io import FORMATS, export_rows, write_rows
+
+class Command(BaseCommand):
+    help = '店舗をCSV/JSONLファイルに書き出します（import_restaurantsで読み込める形式）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='書き出すファイル（省略時は標準出力）')
+        parser.add_argument('--format', choices=FORMATS, help='ファイル形式（省略時は拡張子から判定）')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='1回に読み込む件数')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if format not in FORMATS:
+            raise CommandError(f'ファイル形式を指定してください: {", ".join(FORMATS)}')
+
+        file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        try:
+            write_rows(file, format, export_rows(Restaurant.objects.all(), options['chunk_size']))
+        finally:
+            if file is not sys.stdout:
+                file.close()
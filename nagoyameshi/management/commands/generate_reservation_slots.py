@@ -0,0 +1,26 @@
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from nagoyameshi.models import Restaurant, ReservationSlot
+
+class Command(BaseCommand):
+    help = '座席数が設定された店舗の予約枠を作成します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=60, help='今日から何日分の予約枠を作成するか')
+        parser.add_argument('--refresh', action='store_true', help='今後の予約枠を削除し、店舗の座席数/営業時間と予約から作り直す')
+
+    def handle(self, *args, **options):
+        first_date = timezone.localdate()
+        last_date = first_date + timedelta(days=options['days'] - 1)
+
+        restaurants = Restaurant.objects.filter(capacity__isnull=False).defer('search_document')
+        for restaurant in restaurants.iterator():
+            with transaction.atomic():
+                if options['refresh']:
+                    # 今日の予約枠も削除しないと、今日の分が作り直されない
+                    ReservationSlot.objects.filter(restaurant_id=restaurant, start__gte=timezone.make_aware(datetime.combine(first_date, time.min))).delete()
+                ReservationSlot.objects.ensure(restaurant, first_date, last_date)
+
+        self.stdout.write(self.style.SUCCESS(f'{first_date}から{last_date}までの予約枠を作成しました。'))
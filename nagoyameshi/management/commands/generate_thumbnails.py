@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from django.db import connections
+from nagoyameshi.models import Restaurant, RestaurantPhoto
+from nagoyameshi.thumbnails import init_worker, process
+
+class Command(BaseCommand):
+    help = '既存の店舗画像/店舗写真のサムネイルを作成します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='並列に処理するプロセス数（既定はCPU数）')
+        parser.add_argument('--force', action='store_true', help='作成済みの画像も作り直す')
+
+    def handle(self, *args, **options):
+        tasks = []
+        for model in (Restaurant, RestaurantPhoto):
+            for pk in model.objects.order_by('pk').values_list('pk', flat=True).iterator():
+                tasks.append((model._meta.label, pk))
+
+        # 子プロセスにDB接続を引き継がないよう、プールを作る前に閉じておく
+        connections.close_all()
+
+        updated = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker) as executor:
+            futures = {executor.submit(process, label, pk, options['force']): (label, pk) for label, pk in tasks}
+            for i, future in enumerate(as_completed(futures), 1):
+                label, pk = futures[future]
+                try:
+                    if future.result():
+                        updated += 1
+                except Exception as e:
+                    self.stderr.write(f'{label}(pk={pk}): {e}')
+
+                if i % 100 == 0:
+                    self.stdout.write(f'{i}/{len(tasks)}件を処理しました。')
+
+        self.stdout.write(self.style.SUCCESS(f'{updated}件の画像のサムネイルを作成しました。'))
@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from nagoyameshi.restaurant_io import FORMATS, RestaurantImporter, read_rows
+
+class Command(BaseCommand):
+    help = 'CSV/JSONLファイルから店舗をまとめて登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル（-の場合は標準入力）')
+        parser.add_argument('--format', choices=FORMATS, help='ファイル形式（省略時は拡張子から判定）')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='1回のトランザクションで登録する件数')
+        parser.add_argument('--create-categories', action='store_true', help='存在しないカテゴリーを作成する')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if format not in FORMATS:
+            raise CommandError(f'ファイル形式を指定してください: {", ".join(FORMATS)}')
+
+        importer = RestaurantImporter(options['chunk_size'], options['create_categories'])
+
+        def on_progress(importer):
+            self.stdout.write(f'{importer.imported}件を登録しました。（エラー {len(importer.errors)}件）')
+
+        file = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        try:
+            importer.run(read_rows(file, format), on_progress)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        for line_num, message in importer.errors:
+            self.stderr.write(f'{line_num}行目: {message}')
+        self.stdout.write(self.style.SUCCESS(f'{importer.imported}件の店舗を登録しました。（エラー {len(importer.errors)}件）'))
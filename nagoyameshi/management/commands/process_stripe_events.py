@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from nagoyameshi.subscriptions import process_stripe_events
+
+class Command(BaseCommand):
+    help = 'webhookで受け取ったStripeのイベントをまとめて処理します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='1回に処理するイベントの件数')
+        parser.add_argument('--loop', action='store_true', help='終了せずに処理を続ける')
+        parser.add_argument('--interval', type=float, default=5, help='--loop時、未処理のイベントがない場合に待つ秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            # 未処理のイベントがなくなるまで処理する
+            total = 0
+            while True:
+                try:
+                    processed = process_stripe_events(options['batch_size'])
+                except Exception as e:
+                    # DBの一時的なエラーなどで止まらないよう、--loop時は記録して次の周期にやり直す
+                    if not options['loop']:
+                        raise
+                    self.stderr.write(f'イベントの処理に失敗しました: {type(e).__name__}: {e}')
+                    break
+                total += processed
+                if processed < options['batch_size']:
+                    break
+
+            if total:
+                self.stdout.write(f'{total}件のイベントを処理しました。')
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from nagoyameshi.models import Restaurant, Review
+
+class Command(BaseCommand):
+    help = 'レビューから店舗の星の数の合計とレビュー件数を再集計します。'
+
+    def handle(self, *args, **options):
+        reviews = Review.objects.filter(restaurant_id=OuterRef('pk')).order_by().values('restaurant_id')
+        stars_sum = reviews.annotate(total=Sum('number_of_stars')).values('total')
+        reviews_count = reviews.annotate(total=Count('pk')).values('total')
+
+        # 1回のUPDATE文で全店舗を再集計する
+        updated = Restaurant.objects.update(
+            stars_sum=Coalesce(Subquery(stars_sum, output_field=IntegerField()), Value(0)),
+            reviews_count=Coalesce(Subquery(reviews_count, output_field=IntegerField()), Value(0)),
+        )
+
+        self.stdout.write(self.style.SUCCESS(f'{updated}件の店舗を再集計しました。'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from nagoyameshi import search
+from nagoyameshi.models import Restaurant
+
+class Command(BaseCommand):
+    help = '店舗の全文検索用の文書とインデックスを作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回に保存する店舗の件数')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            search.clear_index()
+            count = search.rebuild_index(Restaurant.objects.all(), options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count}件の店舗の検索用文書を作成しました。'))
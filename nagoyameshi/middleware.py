@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import re
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import SESSION_KEY
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, set_response_etag
+from django.utils.http import http_date, parse_http_date_safe
+
+# ===============================================
+# ページキャッシュ
+# 未ログイン/無料会員向けのページ（settings.PAGE_CACHE_URL_NAMES）を、レンダリング結果ごとキャッシュする。
+# キーにはURL、ページ全体/ユーザーごとのバージョン、ログイン中ならセッションとCSRFのCookieを含める。
+# ===============================================
+PAGE_CACHE_VERSION_KEY = 'page_cache:version'
+PAGE_CACHE_USER_VERSION_KEY = 'page_cache:user:{}'
+
+def has_pending_messages(request):
+    '''
+    表示待ちのメッセージがあるか（セッションを読むだけで、メッセージは既読にしない）
+    '''
+    return CookieStorage.cookie_name in request.COOKIES or bool(request.session.get('_messages'))
+
+def clear_page_cache(user_ids=None):
+    '''
+    ページキャッシュを破棄する。user_idsを指定した場合はそのユーザーのページだけを破棄する
+    '''
+    if user_ids is None:
+        cache.set(PAGE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+        return
+    cache.set_many({PAGE_CACHE_USER_VERSION_KEY.format(user_id): uuid.uuid4().hex for user_id in user_ids}, None)
+
+class PageCacheMiddleware(MiddlewareMixin):
+    # MiddlewareMixinにより、WSGI/ASGIのどちらでもそのまま動く。
+    # ASGIで非同期ビューがスレッドを挟まずに呼ばれるのは、MIDDLEWAREのすべてが非同期に対応している場合だけ
+    def process_response(self, request, response):
+        cache_key = getattr(request, '_page_cache_key', None)
+        if cache_key is None or not self.is_cacheable(request, response):
+            return response
+
+        # ブラウザには毎回確認させ（max-age=0）、変わっていなければ304を返す
+        set_response_etag(response)
+        response['Last-Modified'] = http_date(time.time())
+        patch_vary_headers(response, ['Cookie'])
+        if SESSION_KEY in request.session:
+            patch_cache_control(response, private=True, max_age=0)
+        else:
+            patch_cache_control(response, max_age=0)
+
+        cache.set(cache_key, response, settings.PAGE_CACHE_TIMEOUT)
+        return self.conditional_response(request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD') or request.resolver_match.view_name not in settings.PAGE_CACHE_URL_NAMES:
+            return None
+
+        # 表示待ちのメッセージがある場合、ページに含まれるのでキャッシュを使わない
+        if has_pending_messages(request):
+            return None
+
+        cache_key = self.get_cache_key(request)
+        response = cache.get(cache_key)
+        if response is None:
+            request._page_cache_key = cache_key
+            return None
+
+        return self.conditional_response(request, response)
+
+    def get_cache_key(self, request):
+        user_id = request.session.get(SESSION_KEY)
+        user_version_key = PAGE_CACHE_USER_VERSION_KEY.format(user_id)
+        versions = cache.get_many([PAGE_CACHE_VERSION_KEY, user_version_key])
+
+        parts = [
+            request.build_absolute_uri(),
+            versions.get(PAGE_CACHE_VERSION_KEY, ''),
+            # ページ内のフォームのCSRFトークンはCookieのシークレットごとに異なる
+            request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        ]
+        if user_id is not None:
+            # ログイン中のページはユーザー名などを含むので、セッションごとに分ける
+            parts += [str(user_id), versions.get(user_version_key, ''), request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')]
+
+        return 'page_cache:' + hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+    def is_cacheable(self, request, response):
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return False
+
+        # ビュー側でキャッシュしないよう指定されたページ（有料会員ページなど）
+        cache_control = response.get('Cache-Control', '')
+        if any(directive in cache_control for directive in ('private', 'no-cache', 'no-store')):
+            return False
+
+        # セッションやメッセージが更新された場合、次のリクエストでは表示が変わる
+        if request.session.modified or len(messages.get_messages(request)):
+            return False
+
+        # CSRFのCookieがまだない場合、新しく発行されたトークンは他の訪問者と共有できない
+        if request.META.get('CSRF_COOKIE_NEEDS_UPDATE') and settings.CSRF_COOKIE_NAME not in request.COOKIES:
+            return False
+
+        return True
+
+    def conditional_response(self, request, response):
+        return get_conditional_response(
+            request,
+            etag=response.get('ETag'),
+            last_modified=parse_http_date_safe(response.get('Last-Modified', '')),
+            response=response,
+        )
+
+
+# ===============================================
+# リクエストごとのSQLの計測
+# クエリ数/DB時間/重複したクエリ/ビュー名を記録し、Server-Timingヘッダーとログ（JSON）に出す。
+# ログは、しきい値（QUERY_*）を超えたリクエストだけWARNINGで、それ以外はDEBUGで出す。
+# クエリはすべてのDB接続に追加したexecute_wrapper（record_query）で記録する。
+# 記録先はコンテキスト変数なので、ASGIで同期ビューが別スレッドで動いても同じリクエストに記録される。
+# （ストリーミングレスポンスの送信中のクエリは含まない）
+# ===============================================
+logger = logging.getLogger('nagoyameshi.queries')
+
+_query_metrics = ContextVar('query_metrics', default=None)
+
+# IN (%s, %s, ...) の個数の違いは同じクエリとみなす
+IN_PLACEHOLDERS = re.compile(r'IN \((?:%s, )*%s\)')
+
+def get_fingerprint(sql):
+    return IN_PLACEHOLDERS.sub('IN (...)', ' '.join(sql.split()))
+
+class QueryMetrics:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[get_fingerprint(sql)] += 1
+
+    def get_duplicates(self):
+        '''
+        2回以上実行されたクエリ（N+1の候補）を回数の多い順に返す
+        '''
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count > 1]
+
+def record_query(execute, sql, params, many, context):
+    '''
+    execute_wrapper。計測中のリクエストがあれば、クエリと実行時間を記録する
+    '''
+    metrics = _query_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add(sql, time.perf_counter() - start)
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+class QueryMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        metrics = QueryMetrics()
+        token = _query_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_metrics.reset(token)
+        return self.report(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = QueryMetrics()
+        token = _query_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_metrics.reset(token)
+        return self.report(request, response, metrics, time.perf_counter() - start)
+
+    def report(self, request, response, metrics, duration):
+        duplicates = metrics.get_duplicates()
+        exceeded = (
+            metrics.count > settings.QUERY_COUNT_THRESHOLD
+            or any(count > settings.QUERY_DUPLICATE_THRESHOLD for _, count in duplicates)
+        )
+
+        if settings.QUERY_METRICS_SERVER_TIMING:
+            response['Server-Timing'] = (
+                f'db;dur={metrics.duration * 1000:.1f};desc="{metrics.count} queries", '
+                f'app;dur={duration * 1000:.1f}'
+            )
+
+        level = logging.WARNING if exceeded else logging.DEBUG
+        if not logger.isEnabledFor(level):
+            return response
+
+        resolver_match = request.resolver_match
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': resolver_match.view_name if resolver_match else None,
+            'status': response.status_code,
+            'queries': metrics.count,
+            'db_ms': round(metrics.duration * 1000, 1),
+            'total_ms': round(duration * 1000, 1),
+            'duplicates': [
+                {'fingerprint': hashlib.md5(sql.encode()).hexdigest()[:12], 'count': count, 'sql': sql[:200]}
+                for sql, count in duplicates
+            ],
+            'threshold_exceeded': exceeded,
+        }
+        logger.log(level, json.dumps(record, ensure_ascii=False))
+        return response
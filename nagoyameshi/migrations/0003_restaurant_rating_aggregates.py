@@ -0,0 +1,35 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:10
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_rating_aggregates(apps, schema_editor):
+    # 既存のレビューから集計値を埋める
+    Restaurant = apps.get_model('nagoyameshi', 'Restaurant')
+    Review = apps.get_model('nagoyameshi', 'Review')
+
+    aggregates = Review.objects.values('restaurant_id').annotate(total=Sum('number_of_stars'), count=Count('pk')).order_by()
+    for row in aggregates:
+        Restaurant.objects.filter(pk=row['restaurant_id']).update(stars_sum=row['total'], reviews_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0002_day_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='reviews_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='レビュー件数'),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='stars_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='星の数の合計'),
+        ),
+        migrations.RunPython(fill_rating_aggregates, migrations.RunPython.noop),
+    ]
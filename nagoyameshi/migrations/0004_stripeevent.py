@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0003_restaurant_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='イベントID')),
+                ('type', models.CharField(max_length=100, verbose_name='イベント種別')),
+                ('payload', models.JSONField(verbose_name='イベント内容')),
+                ('stripe_created', models.PositiveBigIntegerField(verbose_name='Stripe上の作成日時')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='受信日時')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='処理日時')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['processed_at', 'stripe_created'], name='stripeevent_unprocessed_idx')],
+            },
+        ),
+    ]
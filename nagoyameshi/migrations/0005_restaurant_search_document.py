@@ -0,0 +1,67 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:16
+
+import re
+import unicodedata
+from django.db import migrations, models
+
+# nagoyameshi.searchの変更がこのマイグレーションに影響しないよう、作成時点の処理をコピーしておく
+FTS_TABLE = 'nagoyameshi_restaurant_fts'
+TS_CONFIG = 'simple'
+WORD_SPLIT = re.compile(r'[\W_]+')
+
+
+def build_document(*texts):
+    tokens = []
+    for text in texts:
+        for word in WORD_SPLIT.split(unicodedata.normalize('NFKC', text or '').lower()):
+            if not word:
+                continue
+            if len(word) <= 2:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return ' '.join(tokens)
+
+
+def create_search_index(apps, schema_editor):
+    # DBごとの全文検索のインデックスを作成する
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS restaurant_search_document_gin ON nagoyameshi_restaurant "
+            f"USING gin (to_tsvector('{TS_CONFIG}'::regconfig, search_document))"
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(document)")
+
+    # 既存の店舗の検索用文書を作成する
+    Restaurant = apps.get_model('nagoyameshi', 'Restaurant')
+    for restaurant in Restaurant.objects.select_related('category_id').iterator():
+        restaurant.search_document = build_document(restaurant.name, restaurant.description, restaurant.city, restaurant.category_id.name)
+        restaurant.save(update_fields=['search_document'])
+        if vendor == 'sqlite':
+            schema_editor.execute(f"INSERT INTO {FTS_TABLE}(rowid, document) VALUES (%s, %s)", [restaurant.pk, restaurant.search_document])
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS restaurant_search_document_gin")
+    elif vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0004_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='検索用文書'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0005_restaurant_search_document'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['name'], name='category_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='extendedmodel',
+            index=models.Index(fields=['created_at', 'id'], name='extendedmodel_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user_id', 'reservation_datetime'], name='reservation_user_datetime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['restaurant_id', 'reservation_datetime'], name='reservation_restaurant_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['category_id', 'floor_price', 'maximum_price'], name='restaurant_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['floor_price'], name='restaurant_floor_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['maximum_price'], name='restaurant_maximum_price_idx'),
+        ),
+    ]
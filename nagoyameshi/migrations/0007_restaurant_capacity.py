@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0006_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='capacity',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='座席数'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0007_restaurant_capacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservationSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='開始日時')),
+                ('capacity', models.PositiveIntegerField(verbose_name='座席数')),
+                ('remaining', models.PositiveIntegerField(verbose_name='残り座席数')),
+                ('restaurant_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nagoyameshi.restaurant', verbose_name='店舗')),
+            ],
+            options={
+                'unique_together': {('restaurant_id', 'start')},
+            },
+        ),
+    ]
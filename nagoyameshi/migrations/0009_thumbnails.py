@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0008_reservationslot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='サムネイル'),
+        ),
+        migrations.AddField(
+            model_name='restaurantphoto',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='サムネイル'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nagoyameshi', '0009_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='error',
+            field=models.TextField(blank=True, default='', verbose_name='エラー'),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.conf import settings
 from django.utils import timezone
 from django.core.validators import RegexValidator
@@ -7,16 +7,30 @@ User = get_user_model()
 from django.core.validators import MinValueValidator,MaxValueValidator
 from django.core.exceptions import ValidationError
 from datetime import datetime, timedelta
-from django.db.models import Avg
+from django.db.models import Case, Count, Exists, F, FloatField, Max, Min, OuterRef, Subquery, Value, When
+from django.db.models.signals import post_save
+from django.db.models.functions import Greatest, Least
+from django.db.models.functions import Cast, Coalesce
 
 # models.Modelを継承した汎用クラス
 class ExtendedModel(models.Model):
+    class Meta:
+        indexes = [
+            # 一覧の作成日順の並び替え（キーセットページネーション）用
+            models.Index(fields=['created_at', 'id'], name='extendedmodel_created_idx'),
+        ]
+
     deleted_at = models.DateTimeField(verbose_name='論理削除日', auto_now=True, blank=True, null=True)
     updated_at = models.DateTimeField(verbose_name='更新日', auto_now=True, blank=True, null=True)
     created_at = models.DateTimeField(verbose_name='作成日', auto_now_add=True)
 
 # カテゴリー
 class Category(ExtendedModel):
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='category_name_idx'),
+        ]
+
     name = models.CharField(verbose_name='カテゴリ名', max_length=15)
 
     def __str__(self):
@@ -31,15 +45,100 @@ class Day(models.Model):
         return self.name
     
 
+# 星の数の平均値を、塗りつぶし/半分/空の星の数分の長さの文字列に変換する
+def split_stars(avg):
+    if not avg:
+        avg = 0
+    
+    true_num = int(avg)
+    half_num = 0
+    false_num = int( MAX_STAR - avg )
+
+    few = avg - true_num
+
+    if few == 0:
+        pass
+    elif 0 < few < 0.4 :
+        false_num += 1
+    elif 0.4 <= few < 0.6:
+        half_num += 1
+    else:
+        true_num += 1
+    
+    avg = round(avg, 2)
+
+    true_star = true_num * ' '
+    half_star = half_num * ' '
+    false_star = false_num * ' '
+    return {'num':avg, 'true_star': true_star, 'half_star': half_star, 'false_star': false_star}
+
+
 # 店舗
 def get_top_image_path(instance, filename):
     return "nagoyameshi/restaurant/%s/top/%s"%(str(instance.pk), filename)
 
+def average_stars():
+    '''
+    星の数の平均（レビューがなければ0）。レビューを集計せず、店舗の集計列(stars_sum/reviews_count)から求める
+    '''
+    return Case(
+        When(reviews_count=0, then=Value(0.0)),
+        default=Cast('stars_sum', FloatField()) / F('reviews_count'),
+        output_field=FloatField(),
+    )
+
+class RestaurantQuerySet(models.QuerySet):
+    def with_rating(self):
+        '''
+        レビューの星の数の平均(avg_stars)と件数(num_reviews)を付与する
+        '''
+        return self.annotate(avg_stars=average_stars(), num_reviews=F('reviews_count'))
+
+    def with_score(self):
+        '''
+        並び替え/キーセットページネーション用のスコア(score)を付与する。
+        集計を使わないので、ページの絞り込みはWHEREで行われる
+        '''
+        return self.annotate(score=average_stars())
+
+    def listing(self):
+        '''
+        店舗一覧/詳細用。カテゴリとレビューの集計を1回のSQLで取得する
+        '''
+        return self.select_related('category_id').defer('search_document').with_rating()
+
+    def page_state(self, user):
+        '''
+        店舗詳細/レビュー一覧のETag用。店舗/カテゴリの更新日時、レビュー/写真の最終更新日時と件数、お気に入りの状態を1回のSQLで取得する
+        '''
+        def aggregate(model, expression):
+            rows = model.objects.filter(restaurant_id=OuterRef('pk')).order_by().values('restaurant_id')
+            return Subquery(rows.annotate(value=expression).values('value'))
+
+        return self.values(
+            'updated_at', 'category_id__updated_at', 'stars_sum', 'reviews_count',
+            latest_review=aggregate(Review, Max('updated_at')),
+            latest_photo=aggregate(RestaurantPhoto, Max('updated_at')),
+            photos_count=aggregate(RestaurantPhoto, Count('pk')),
+            is_favorite=Exists(Favorite.objects.filter(user_id=user, restaurant_id=OuterRef('pk'))),
+        )
+
 class Restaurant(ExtendedModel):
+    class Meta:
+        indexes = [
+            # 店舗一覧のカテゴリ+予算での絞り込み用
+            models.Index(fields=['category_id', 'floor_price', 'maximum_price'], name='restaurant_category_price_idx'),
+            # 予算だけでの絞り込み用
+            models.Index(fields=['floor_price'], name='restaurant_floor_price_idx'),
+            models.Index(fields=['maximum_price'], name='restaurant_maximum_price_idx'),
+        ]
+
     name = models.CharField(verbose_name='店舗名', max_length=30)
     category_id = models.ForeignKey(Category, verbose_name='カテゴリー', on_delete=models.PROTECT)
     description = models.CharField(verbose_name='店舗説明', max_length=500)
     image = models.ImageField(verbose_name='トップ画像', upload_to=get_top_image_path, 	blank=True, default='nagoyameshi/noimage.png')
+    # 画像から生成したサムネイルの情報（nagoyameshi.thumbnails）
+    thumbnails = models.JSONField(verbose_name='サムネイル', default=dict, blank=True, editable=False)
     floor_price = models.PositiveIntegerField(verbose_name='下限価格')
     maximum_price = models.PositiveIntegerField(verbose_name='上限価格')
     opening_time = models.TimeField(verbose_name='開店時刻')
@@ -56,6 +155,18 @@ class Restaurant(ExtendedModel):
 
     regular_closing_day = models.ManyToManyField(Day, verbose_name='定休日')
 
+    # 未設定の場合は予約人数を制限しない
+    capacity = models.PositiveIntegerField(verbose_name='座席数', blank=True, null=True)
+
+    # レビューの集計値（Reviewの保存・削除時にsignals.pyで更新する）
+    stars_sum = models.PositiveIntegerField(verbose_name='星の数の合計', default=0, editable=False)
+    reviews_count = models.PositiveIntegerField(verbose_name='レビュー件数', default=0, editable=False)
+
+    # 全文検索用の文書（n-gramに分割した店名/説明/市区町村/カテゴリ名。search.pyで作成する）
+    search_document = models.TextField(verbose_name='検索用文書', default='', blank=True, editable=False)
+
+    objects = RestaurantQuerySet.as_manager()
+
     def __str__(self):
         return self.name
     
@@ -63,39 +174,21 @@ class Restaurant(ExtendedModel):
         return "\n".join([day.name for day in self.regular_closing_day.all()])
     
     def count_reviews(self):
-        return Review.objects.filter(restaurant_id=self.id).count()
+        return self.reviews_count
+
+    def stars_avg(self):
+        '''
+        星の数の平均値を返すメソッド（レビューがなければ0）
+        '''
+        if not self.reviews_count:
+            return 0
+        return self.stars_sum / self.reviews_count
 
     def stars_avg_str(self):
         '''
         星の数の平均値を文字列の長さに変換するメソッド
         '''
-        reviews = Review.objects.filter(restaurant_id=self.id).aggregate(Avg("number_of_stars"))
-        avg     = reviews["number_of_stars__avg"]
-
-        if not avg:
-            avg = 0
-        
-        true_num = int(avg)
-        half_num = 0
-        false_num = int( MAX_STAR - avg )
-
-        few = avg - true_num
-
-        if few == 0:
-            pass
-        elif 0 < few < 0.4 :
-            false_num += 1
-        elif 0.4 <= few < 0.6:
-            half_num += 1
-        else:
-            true_num += 1
-        
-        avg = round(avg, 2)
-
-        true_star = true_num * ' '
-        half_star = half_num * ' '
-        false_star = false_num * ' '
-        return {'num':avg, 'true_star': true_star, 'half_star': half_star, 'false_star': false_star}
+        return split_stars(self.stars_avg())
         
         
     def number_of_stars_str(self):
@@ -113,9 +206,21 @@ def get_photos_path(instance, filename):
 class RestaurantPhoto(ExtendedModel):
     restaurant_id = models.ForeignKey(Restaurant, verbose_name='店舗', on_delete=models.CASCADE)
     image = models.ImageField(verbose_name='画像', upload_to=get_photos_path)
+    # 画像から生成したサムネイルの情報（nagoyameshi.thumbnails）
+    thumbnails = models.JSONField(verbose_name='サムネイル', default=dict, blank=True, editable=False)
 
 # レビュー
 MAX_STAR = 5
+class ReviewQuerySet(models.QuerySet):
+    def listing(self):
+        '''
+        レビュー一覧用。投稿者をJOINして1回のSQLで取得し、表示に使う列だけを読み込む
+        '''
+        return self.select_related('user_id').only(
+            'created_at', 'restaurant_id', 'number_of_stars', 'comment', 'visited_date',
+            'user_id__username',
+        )
+
 class Review(ExtendedModel):
     restaurant_id = models.ForeignKey(Restaurant, verbose_name='店舗', on_delete=models.CASCADE)
     user_id = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name="ユーザー", on_delete=models.CASCADE)
@@ -123,6 +228,8 @@ class Review(ExtendedModel):
     comment = models.CharField(verbose_name='コメント', max_length=800)
     visited_date = models.DateField(verbose_name='利用日')
 
+    objects = ReviewQuerySet.as_manager()
+
     def number_of_stars_str(self):
         '''
         星の数分の長さの文字列を返すメソッド
@@ -141,6 +248,43 @@ class Review(ExtendedModel):
             raise ValidationError("利用日には過去の日付を選択してください。")
 
 # お気に入り
+class FavoriteQuerySet(models.QuerySet):
+    def toggle(self, user, restaurant_id):
+        '''
+        お気に入りを登録/解除し、登録した場合はTrueを返す。
+        登録済みならDELETEだけ、未登録なら店舗が存在する場合だけINSERTする（重複はunique_togetherで防ぐ）。
+        店舗が存在しない場合はRestaurant.DoesNotExist
+        '''
+        deleted, _ = self.filter(user_id=user, restaurant_id=restaurant_id).delete()
+        if deleted:
+            return False
+
+        # 外部キー制約はコミット時まで検査されないことがあるので、店舗の存在はINSERT文の中で確かめる
+        favorite = self.model._meta
+        restaurant = Restaurant._meta
+        restaurant_field, user_field = favorite.get_field('restaurant_id'), favorite.get_field('user_id')
+        sql = (
+            f'INSERT INTO {favorite.db_table} ({restaurant_field.column}, {user_field.column}) '
+            f'SELECT %s, %s WHERE EXISTS (SELECT 1 FROM {restaurant.db_table} WHERE {restaurant.pk.column} = %s)'
+        )
+        restaurant_id = restaurant_field.get_db_prep_value(restaurant_id, connection)
+        user_id = user_field.get_db_prep_value(user.pk, connection)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [restaurant_id, user_id, restaurant_id])
+                inserted = cursor.rowcount
+        except IntegrityError:
+            # 同時に登録された（一意制約）
+            return True
+
+        if not inserted:
+            raise Restaurant.DoesNotExist
+
+        # INSERTはSQLで行うので、保存時のシグナル（お気に入りのキャッシュの破棄）は自分で送る
+        instance = self.model(user_id=user, restaurant_id_id=restaurant_id)
+        post_save.send(sender=self.model, instance=instance, created=True, raw=False, using=self.db, update_fields=None)
+        return True
+
 class Favorite(models.Model):
     class Meta:
         unique_together=("user_id","restaurant_id")
@@ -148,15 +292,194 @@ class Favorite(models.Model):
     restaurant_id = models.ForeignKey(Restaurant, verbose_name='店舗', on_delete=models.CASCADE)
     user_id = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name="ユーザー", on_delete=models.CASCADE)
 
+    objects = FavoriteQuerySet.as_manager()
+
 
 # 予約
+# 1件の予約で席を使う時間。ユーザーはこの時間内に別の予約を入れられない
+RESERVATION_INTERVAL = timedelta(hours=2)
+
+# 予約枠の長さ
+SLOT_LENGTH = timedelta(minutes=30)
+
+def floor_to_slot(value):
+    '''
+    日時を予約枠の開始日時に切り捨てる
+    '''
+    value = timezone.localtime(value)
+    minutes = int(SLOT_LENGTH.total_seconds() // 60)
+    return value.replace(minute=value.minute - value.minute % minutes, second=0, microsecond=0)
+
+def slot_starts(restaurant, date, closing_day_keys):
+    '''
+    営業日の予約枠の開始日時の一覧（開店から閉店まで）。定休日は空のリストを返す
+    '''
+    if date.weekday() in closing_day_keys:
+        return []
+
+    starts = []
+    current = timezone.make_aware(datetime.combine(date, restaurant.opening_time))
+    closing = timezone.make_aware(datetime.combine(date, restaurant.closing_time))
+    while current < closing:
+        starts.append(current)
+        current += SLOT_LENGTH
+    return starts
+
+class ReservationSlotQuerySet(models.QuerySet):
+    def covering(self, restaurant, reservation_datetime):
+        '''
+        予約日時から席を使う時間に含まれる予約枠
+        '''
+        return self.filter(
+            restaurant_id=restaurant,
+            start__gte=floor_to_slot(reservation_datetime),
+            start__lt=reservation_datetime + RESERVATION_INTERVAL,
+        )
+
+    def ensure(self, restaurant, first_date, last_date):
+        '''
+        期間内でまだ作成されていない日の予約枠を作成する（過去の日は作成しない）。
+        残り座席数は作成時点の予約から計算する
+        '''
+        first_date = max(first_date, timezone.localdate())
+        if restaurant.capacity is None or first_date > last_date:
+            return
+
+        created_dates = set(start.date() for start in self.filter(
+            restaurant_id=restaurant,
+            start__gte=timezone.make_aware(datetime.combine(first_date, datetime.min.time())),
+            start__lt=timezone.make_aware(datetime.combine(last_date + timedelta(days=1), datetime.min.time())),
+        ).datetimes('start', 'day'))
+
+        closing_day_keys = set(restaurant.regular_closing_day.values_list('key', flat=True))
+        starts = []
+        date = first_date
+        while date <= last_date:
+            if date not in created_dates:
+                starts.extend(slot_starts(restaurant, date, closing_day_keys))
+            date += timedelta(days=1)
+        if not starts:
+            return
+
+        # 作成する予約枠に重なる予約を1回で取得し、予約枠ごとの予約済み人数を計算する
+        reservations = list(Reservation.objects.filter(
+            restaurant_id=restaurant,
+            reservation_datetime__gt=starts[0] - RESERVATION_INTERVAL,
+            reservation_datetime__lt=starts[-1] + SLOT_LENGTH,
+        ).values_list('reservation_datetime', 'number_of_persons'))
+
+        slots = []
+        for start in starts:
+            reserved = sum(persons for reserved_at, persons in reservations
+                           if reserved_at < start + SLOT_LENGTH and start < reserved_at + RESERVATION_INTERVAL)
+            slots.append(ReservationSlot(restaurant_id=restaurant, start=start, capacity=restaurant.capacity,
+                                         remaining=max(restaurant.capacity - reserved, 0)))
+        self.bulk_create(slots, ignore_conflicts=True)
+
+    def reserve(self, restaurant, reservation_datetime, number_of_persons):
+        '''
+        予約の保存後に、予約枠の残り座席数を減らす（0未満にはしない）。座席数のチェックはReservation.clean()で行う。
+        予約枠がまだない日は、保存した予約を含めて予約枠を作成する
+        '''
+        slots = self.covering(restaurant, reservation_datetime)
+        if not slots.exists():
+            date = timezone.localtime(reservation_datetime).date()
+            self.ensure(restaurant, date, date)
+            return
+        slots.update(remaining=Greatest(F('remaining') - number_of_persons, 0))
+
+    def rebuild(self, restaurant):
+        '''
+        今日以降の作成済みの予約枠を削除し、店舗の座席数/営業時間/定休日と予約から作り直す。
+        座席数を未設定にした場合は削除だけ行う
+        '''
+        today = timezone.localdate()
+        slots = self.filter(restaurant_id=restaurant, start__gte=timezone.make_aware(datetime.combine(today, datetime.min.time())))
+        last_start = slots.aggregate(last_start=Max('start'))['last_start']
+        slots.delete()
+        if restaurant.capacity is None or last_start is None:
+            return
+        self.ensure(restaurant, today, timezone.localtime(last_start).date())
+
+    def release(self, restaurant, reservation_datetime, number_of_persons):
+        '''
+        予約の取り消しなどで、予約枠の残り座席数を戻す
+        '''
+        self.covering(restaurant, reservation_datetime).update(remaining=Least(F('remaining') + number_of_persons, F('capacity')))
+
+    def for_month(self, restaurant, year, month):
+        '''
+        月内の予約枠（予約可否の表示用）。予約枠がまだない日は作成してから返す
+        '''
+        first_date = datetime(year, month, 1).date()
+        last_date = (datetime(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).date()
+        self.ensure(restaurant, first_date, last_date)
+        return self.filter(
+            restaurant_id=restaurant,
+            start__gte=timezone.make_aware(datetime.combine(first_date, datetime.min.time())),
+            start__lt=timezone.make_aware(datetime.combine(last_date + timedelta(days=1), datetime.min.time())),
+        ).order_by('start')
+
+# 予約枠（店舗ごと/30分ごとの残り座席数）
+class ReservationSlot(models.Model):
+    class Meta:
+        unique_together=("restaurant_id", "start")
+
+    restaurant_id = models.ForeignKey(Restaurant, verbose_name='店舗', on_delete=models.CASCADE)
+    start = models.DateTimeField(verbose_name='開始日時')
+    capacity = models.PositiveIntegerField(verbose_name='座席数')
+    remaining = models.PositiveIntegerField(verbose_name='残り座席数')
+
+    objects = ReservationSlotQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.restaurant_id} {timezone.localtime(self.start)}'
+
+class ReservationQuerySet(models.QuerySet):
+    def availability(self, user, restaurant, reservation_datetime):
+        '''
+        予約日時の前後の、ユーザーの予約件数(user_reservations)と店舗の残り座席数(remaining_seats)を1回のSQLで取得する。
+        remaining_seatsは予約枠(ReservationSlot)から求め、座席数が未設定の店舗ではNoneになる
+        '''
+        start = reservation_datetime - RESERVATION_INTERVAL
+        end = reservation_datetime + RESERVATION_INTERVAL
+
+        user_reservations = self.filter(user_id=user, reservation_datetime__gte=start, reservation_datetime__lte=end).order_by().values('user_id')
+        user_reservations = user_reservations.annotate(count=Count('pk')).values('count')
+
+        remaining_seats = ReservationSlot.objects.covering(restaurant, reservation_datetime).order_by().values('restaurant_id')
+        remaining_seats = remaining_seats.annotate(remaining=Min('remaining')).values('remaining')
+
+        return Restaurant.objects.filter(pk=restaurant.pk).values(
+            user_reservations=Coalesce(Subquery(user_reservations), 0),
+            remaining_seats=Subquery(remaining_seats),
+        ).get()
+
+def lock_for_reservation(user, restaurant):
+    '''
+    同じユーザー/同じ店舗への予約が同時に処理されないよう、店舗とユーザーの行をロックする。
+    transaction.atomic()の中で、バリデーションの前に呼ぶこと
+    '''
+    list(Restaurant.objects.select_for_update(of=('self', )).filter(pk=restaurant.pk).values_list('pk'))
+    list(User.objects.select_for_update().filter(pk=user.pk).values_list('pk'))
+
 class Reservation(ExtendedModel):
+    class Meta:
+        indexes = [
+            # 予約の重複チェック/マイページの予約一覧用
+            models.Index(fields=['user_id', 'reservation_datetime'], name='reservation_user_datetime_idx'),
+            # 店舗ごとの予約状況の確認用
+            models.Index(fields=['restaurant_id', 'reservation_datetime'], name='reservation_restaurant_dt_idx'),
+        ]
+
     user_id = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name="ユーザー", on_delete=models.CASCADE)
     restaurant_id = models.ForeignKey(Restaurant, verbose_name='店舗', on_delete=models.CASCADE)
     reservation_datetime = models.DateTimeField(verbose_name='予約日時')
     number_of_persons = models.PositiveIntegerField(verbose_name='予約人数')
     comment = models.CharField(verbose_name='コメント', max_length=200, null=True, blank=True)
 
+    objects = ReservationQuerySet.as_manager()
+
     def clean(self):
         '''
         バリデーション
@@ -178,11 +501,69 @@ class Reservation(ExtendedModel):
         if restaurant.regular_closing_day.filter(key=weekday).exists():
             raise ValidationError('定休日に予約することはできません。別の曜日を選択してください。')
         
-        # 前後2時間に別の店舗を予約している場合エラーを返す
-        start = self.reservation_datetime - timedelta(hours=2)
-        end = self.reservation_datetime + timedelta(hours=2)
-        if Reservation.objects.filter(reservation_datetime__gte=start, reservation_datetime__lte=end).exists():
-            raise ValidationError('指定された日時の前後2時間に別の店舗を予約済みのため、予約することができません。')
+        # 座席数が設定された店舗は、予約日の予約枠を用意しておく
+        if restaurant.capacity is not None:
+            ReservationSlot.objects.ensure(restaurant, self.reservation_datetime.date(), self.reservation_datetime.date())
+
+        # 自分の予約と店舗の予約状況を集計する（変更の場合は自分自身を除く）
+        reservations = Reservation.objects.all()
+        if self.pk:
+            reservations = reservations.exclude(pk=self.pk)
+        availability = reservations.availability(self.user_id, restaurant, self.reservation_datetime)
+
+        # 前後2時間に別の予約がある場合エラーを返す
+        if availability['user_reservations']:
+            raise ValidationError('指定された日時の前後2時間に別の予約があるため、予約することができません。')
+
+        # 座席数を超える場合エラーを返す
+        # （同時に申し込まれても超えないよう、lock_for_reservation()で店舗をロックしてから呼ぶこと）
+        if restaurant.capacity is None:
+            return
+        remaining_seats = availability['remaining_seats']
+        if remaining_seats is not None and self.pk:
+            remaining_seats = self.get_remaining_seats_excluding_self(restaurant)
+        if remaining_seats is None:
+            # 予約枠がない日時（営業時間外など）は座席を確保できない
+            raise ValidationError('指定された日時は予約を受け付けていません。別の日時を選択してください。')
+        if remaining_seats < self.number_of_persons:
+            raise ValidationError('指定された日時は満席のため、予約することができません。別の日時を選択してください。')
 
 
+    def get_remaining_seats_excluding_self(self, restaurant):
+        '''
+        変更の場合の残り座席数。予約枠の残り座席数には変更前の自分の人数が含まれているので、
+        変更前の予約と重なる予約枠ではその人数を戻して計算する
+        '''
+        slots = list(ReservationSlot.objects.covering(restaurant, self.reservation_datetime).values_list('start', 'remaining'))
+        if not slots:
+            return None
+
+        previous = Reservation.objects.filter(pk=self.pk).values_list('restaurant_id', 'reservation_datetime', 'number_of_persons').first()
+        if previous is None or previous[0] != restaurant.pk:
+            return min(remaining for start, remaining in slots)
 
+        _, previous_datetime, previous_persons = previous
+        previous_start = floor_to_slot(previous_datetime)
+        return min(
+            remaining + (previous_persons if previous_start <= start < previous_datetime + RESERVATION_INTERVAL else 0)
+            for start, remaining in slots
+        )
+
+
+# Stripeのwebhookで受け取ったイベント（イベントIDで重複を除く）
+class StripeEvent(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'stripe_created'], name='stripeevent_unprocessed_idx'),
+        ]
+
+    event_id = models.CharField(verbose_name='イベントID', max_length=255, unique=True)
+    type = models.CharField(verbose_name='イベント種別', max_length=100)
+    payload = models.JSONField(verbose_name='イベント内容')
+    stripe_created = models.PositiveBigIntegerField(verbose_name='Stripe上の作成日時')
+    created_at = models.DateTimeField(verbose_name='受信日時', auto_now_add=True)
+    processed_at = models.DateTimeField(verbose_name='処理日時', blank=True, null=True)
+    error = models.TextField(verbose_name='エラー', blank=True, default='')
+
+    def __str__(self):
+        return self.event_id
@@ -0,0 +1,122 @@
+import base64
+import json
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+# ===============================================
+# キーセット（カーソル）ページネーション
+# OFFSETを使わず、前ページの最後の行の値より後ろを検索するので、何ページ目でも同じコストで取得できる。
+# ===============================================
+def encode_cursor(values):
+    data = json.dumps(values, default=str)
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+def decode_cursor(cursor):
+    '''
+    カーソルを値のリストに戻す。不正なカーソルの場合はNoneを返す
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+
+    if not isinstance(values, list):
+        return None
+    return values
+
+def get_ordering_field(queryset, name):
+    '''
+    並び順のキー（pk、モデルのフィールド、annotateした値）に対応するフィールドを返す
+    '''
+    if name == 'pk':
+        return queryset.model._meta.pk
+    if name in queryset.query.annotations:
+        return queryset.query.annotations[name].output_field
+    return queryset.model._meta.get_field(name)
+
+def clean_cursor(queryset, ordering, values):
+    '''
+    カーソルの値を並び順の各フィールドの型に変換する。変換できない場合はNoneを返す
+    '''
+    if values is None or len(values) != len(ordering):
+        return None
+
+    cleaned = []
+    for key, value in zip(ordering, values):
+        # None、dict、listなどはフィールドの値として扱えない
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            return None
+        try:
+            field = get_ordering_field(queryset, key.lstrip('-'))
+            value = field.to_python(value)
+        except (FieldDoesNotExist, ValidationError, TypeError, ValueError):
+            return None
+        if value is None:
+            return None
+        cleaned.append(value)
+    return cleaned
+
+def keyset_filter(ordering, values):
+    '''
+    並び順orderingにおいて、valuesより後ろにある行の条件を返す
+    例: ['-created_at', '-pk'] なら created_at < v1 OR (created_at = v1 AND pk < v2)
+    '''
+    query = Q()
+    for i, key in enumerate(ordering):
+        name = key.lstrip('-')
+        lookup = '__lt' if key.startswith('-') else '__gt'
+        condition = Q(**{name + lookup: values[i]})
+        for previous_key, previous_value in zip(ordering[:i], values[:i]):
+            condition &= Q(**{previous_key.lstrip('-'): previous_value})
+        query |= condition
+    return query
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, next_query, first_query, is_first):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.next_query = next_query
+        self.first_query = first_query
+        self.is_first = is_first
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+def paginate_by_keyset(request, queryset, ordering, per_page):
+    '''
+    リクエストの?cursor=をもとに、orderingの並び順でper_page件を取得する。
+    orderingの最後には一意な列（pkなど）を指定すること。不正なカーソルは最初のページとして扱う
+    '''
+    queryset = queryset.order_by(*ordering)
+
+    cursor = request.GET.get('cursor')
+    values = clean_cursor(queryset, ordering, decode_cursor(cursor)) if cursor else None
+    # 不正なカーソルは最初のページとして扱う
+    if values is not None:
+        queryset = queryset.filter(keyset_filter(ordering, values))
+
+    # 1件多く取得して、次のページがあるかを判定する
+    object_list = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        last = object_list[-1]
+        next_cursor = encode_cursor([getattr(last, key.lstrip('-')) for key in ordering])
+
+    # 次のページ/最初のページへのクエリ文字列（検索条件は引き継ぐ）
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    first_query = params.urlencode()
+    next_query = None
+    if next_cursor:
+        params['cursor'] = next_cursor
+        next_query = params.urlencode()
+
+    return KeysetPage(object_list, next_cursor, next_query, first_query, values is None)
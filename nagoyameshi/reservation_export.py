@@ -0,0 +1,85 @@
+import csv
+from datetime import datetime, time, timedelta
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+# ===============================================
+# 予約のCSVエクスポート（店舗向け）
+# 予約をiterator()で少しずつ読み込みながら1行ずつ書き出すので、件数が多くてもメモリに全件を載せない。
+# ===============================================
+# ASGIで一度に送る行数
+ASYNC_CHUNK_ROWS = 500
+
+HEADER = ['予約ID', '予約日時', '予約人数', 'コメント', '店舗ID', '店舗名', 'ユーザー名', 'メールアドレス', '電話番号', '作成日時']
+
+def filter_reservations(queryset, restaurant_id=None, date_from=None, date_to=None):
+    '''
+    店舗と予約日（date_from〜date_toの両端を含む）で絞り込む
+    '''
+    if restaurant_id:
+        queryset = queryset.filter(restaurant_id=restaurant_id)
+    if date_from:
+        queryset = queryset.filter(reservation_datetime__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+    if date_to:
+        queryset = queryset.filter(reservation_datetime__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min)))
+    return queryset
+
+def export_rows(queryset, chunk_size=2000):
+    '''
+    ヘッダーと予約の行を1行ずつ返す
+    '''
+    yield HEADER
+
+    reservations = (
+        queryset.select_related('restaurant_id', 'user_id')
+        .only(
+            'reservation_datetime', 'number_of_persons', 'comment', 'created_at',
+            'restaurant_id__name', 'user_id__username', 'user_id__email', 'user_id__phone_number',
+        )
+        .order_by('reservation_datetime', 'pk')
+    )
+    for reservation in reservations.iterator(chunk_size=chunk_size):
+        yield [
+            reservation.pk,
+            timezone.localtime(reservation.reservation_datetime).strftime('%Y-%m-%d %H:%M'),
+            reservation.number_of_persons,
+            reservation.comment or '',
+            reservation.restaurant_id_id,
+            reservation.restaurant_id.name,
+            reservation.user_id.username,
+            reservation.user_id.email,
+            reservation.user_id.phone_number or '',
+            timezone.localtime(reservation.created_at).strftime('%Y-%m-%d %H:%M'),
+        ]
+
+class Echo:
+    '''
+    csv.writerの書き込み先。書き込まれた文字列をそのまま返す（StreamingHttpResponseで1行ずつ送る用）
+    '''
+    def write(self, value):
+        return value
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    # Excelで開いたときに文字化けしないようBOMを付ける
+    yield '\ufeff'
+    for row in rows:
+        yield writer.writerow(row)
+
+async def astream_csv(rows, chunk_rows=None):
+    '''
+    stream_csvの非同期版（ASGI用）。
+    ASGIでは同期イテレータのStreamingHttpResponseは全件をlist()してから送られるため、
+    DBの読み込みはスレッドで行い、chunk_rows行ずつ送信する
+    '''
+    chunk_rows = chunk_rows or ASYNC_CHUNK_ROWS
+    lines = stream_csv(rows)
+    # iterator()のカーソルは同じスレッド（同じDB接続）で読む必要がある
+    read_chunk = sync_to_async(lambda: ''.join(islice(lines, chunk_rows)), thread_sensitive=True)
+    try:
+        while chunk := await read_chunk():
+            yield chunk
+    finally:
+        # 途中で切断された場合もカーソルを閉じる
+        await sync_to_async(lines.close, thread_sensitive=True)()
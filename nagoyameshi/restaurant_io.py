@@ -0,0 +1,205 @@
+import csv
+import json
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from . import search
+from .models import Category, Day, ExtendedModel, Restaurant
+
+# ===============================================
+# 店舗のインポート/エクスポート（CSV/JSONL）
+# 1行ずつ読み書きし、chunk_size件ごとにまとめて保存するので、件数が多くてもメモリ使用量は一定。
+# ===============================================
+FIELDS = [
+    'name', 'category', 'description', 'floor_price', 'maximum_price', 'opening_time', 'closing_time',
+    'postal_code', 'city', 'street_address', 'phone_number', 'capacity', 'regular_closing_day',
+]
+FORMATS = ('csv', 'jsonl')
+
+# CSVの定休日は「月曜日 火曜日」のように空白区切りにする
+CLOSING_DAY_SEPARATOR = ' '
+
+def read_rows(file, format):
+    '''
+    ファイルから(行番号, 行の辞書)を1行ずつ返す
+    '''
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            row['regular_closing_day'] = (row.get('regular_closing_day') or '').split()
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = e
+        yield line_num, row
+
+def write_rows(file, format, rows):
+    '''
+    行の辞書を1行ずつファイルに書き出す
+    '''
+    if format == 'csv':
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            row['regular_closing_day'] = CLOSING_DAY_SEPARATOR.join(row['regular_closing_day'])
+            writer.writerow(row)
+        return
+
+    for row in rows:
+        file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+def export_rows(queryset, chunk_size=2000):
+    '''
+    店舗を行の辞書として1件ずつ返す
+    '''
+    restaurants = queryset.select_related('category_id').prefetch_related('regular_closing_day').defer('search_document', 'thumbnails').order_by('pk')
+    for restaurant in restaurants.iterator(chunk_size=chunk_size):
+        yield {
+            'name': restaurant.name,
+            'category': restaurant.category_id.name,
+            'description': restaurant.description,
+            'floor_price': restaurant.floor_price,
+            'maximum_price': restaurant.maximum_price,
+            'opening_time': restaurant.opening_time.strftime('%H:%M'),
+            'closing_time': restaurant.closing_time.strftime('%H:%M'),
+            'postal_code': restaurant.postal_code,
+            'city': restaurant.city,
+            'street_address': restaurant.street_address,
+            'phone_number': restaurant.phone_number,
+            'capacity': restaurant.capacity,
+            'regular_closing_day': [day.name for day in restaurant.regular_closing_day.all()],
+        }
+
+class RestaurantImporter:
+    '''
+    行の辞書から店舗を作成する。カテゴリ/曜日は最初にすべて読み込み、DBに問い合わせずに解決する
+    '''
+    def __init__(self, chunk_size=1000, create_categories=False):
+        self.chunk_size = chunk_size
+        self.create_categories = create_categories
+        self.categories = {category.name: category for category in Category.objects.all()}
+        self.days = {}
+        for day in Day.objects.all():
+            self.days[day.name] = day
+            self.days[str(day.key)] = day
+        self.imported = 0
+        self.errors = []
+
+    def run(self, rows, on_progress=None):
+        '''
+        rowsは(行番号, 行の辞書)。エラーの行は飛ばして self.errors に(行番号, メッセージ)を記録する
+        '''
+        chunk = []
+        for line_num, row in rows:
+            try:
+                restaurant = self.build(row)
+                restaurant._line_num = line_num
+                chunk.append(restaurant)
+            except ValidationError as e:
+                if hasattr(e, 'error_dict'):
+                    message = '; '.join(f'{field}: {error}' for field, errors in e.message_dict.items() for error in errors)
+                else:
+                    message = '; '.join(e.messages)
+                self.errors.append((line_num, message))
+                continue
+
+            if len(chunk) >= self.chunk_size:
+                self.save_chunk(chunk)
+                chunk = []
+                if on_progress:
+                    on_progress(self)
+
+        if chunk:
+            self.save_chunk(chunk)
+            if on_progress:
+                on_progress(self)
+        return self.imported
+
+    def save_chunk(self, restaurants):
+        '''
+        まとめて保存する。保存に失敗した場合はそのまとまりだけを取り消し、エラーに記録して続ける
+        '''
+        try:
+            self.save(restaurants)
+        except DatabaseError as e:
+            first, last = restaurants[0]._line_num, restaurants[-1]._line_num
+            self.errors.append((first, f'{last}行目までの{len(restaurants)}件を登録できませんでした: {e}'))
+
+    def build(self, row):
+        '''
+        行の辞書から保存前の店舗と定休日を作る。不正な値の場合はValidationError
+        '''
+        if not isinstance(row, dict):
+            raise ValidationError(f'行を読み込めません: {row}')
+
+        missing = [field for field in FIELDS if field not in row and field not in ('capacity', 'regular_closing_day')]
+        if missing:
+            raise ValidationError(f'項目がありません: {", ".join(missing)}')
+
+        category = self.get_category(row['category'])
+
+        closing_days = []
+        for value in row.get('regular_closing_day') or []:
+            day = self.days.get(str(value))
+            if day is None:
+                raise ValidationError(f'定休日が不正です: {value}')
+            closing_days.append(day)
+
+        restaurant = Restaurant(
+            name=row['name'],
+            category_id=category,
+            description=row['description'],
+            floor_price=row['floor_price'],
+            maximum_price=row['maximum_price'],
+            opening_time=row['opening_time'],
+            closing_time=row['closing_time'],
+            postal_code=row['postal_code'],
+            city=row['city'],
+            street_address=row['street_address'],
+            phone_number=row['phone_number'],
+            capacity=row.get('capacity') or None,
+        )
+        # 値の変換と入力チェック（カテゴリは解決済みなので、存在チェックのクエリを出さないよう除外する）
+        restaurant.clean_fields(exclude=['category_id', 'extendedmodel_ptr'])
+        restaurant.search_document = search.build_document(restaurant.name, restaurant.description, restaurant.city, category.name)
+        restaurant._closing_days = closing_days
+        return restaurant
+
+    def get_category(self, name):
+        category = self.categories.get(name)
+        if category is None:
+            if not self.create_categories or not name:
+                raise ValidationError(f'カテゴリーがありません: {name}')
+            category = Category.objects.create(name=name)
+            self.categories[name] = category
+        return category
+
+    @transaction.atomic
+    def save(self, restaurants):
+        '''
+        chunk_size件の店舗を1つのトランザクションで保存する。
+        Restaurantは継承したモデル(ExtendedModel)なのでbulk_createが使えず、
+        親テーブルをbulk_createしてから、店舗のテーブルだけにINSERTする（raw=Trueで親は保存し直さず、シグナルも何もしない）
+        '''
+        now = timezone.now()
+        parents = ExtendedModel.objects.bulk_create([ExtendedModel(created_at=now, updated_at=now) for _ in restaurants])
+        for restaurant, parent in zip(restaurants, parents):
+            restaurant.extendedmodel_ptr = parent
+            restaurant.id = parent.id
+            restaurant.created_at = restaurant.updated_at = now
+            restaurant.save_base(raw=True, force_insert=True)
+
+        ClosingDay = Restaurant.regular_closing_day.through
+        ClosingDay.objects.bulk_create([
+            ClosingDay(restaurant_id=restaurant.pk, day_id=day.pk)
+            for restaurant in restaurants for day in restaurant._closing_days
+        ])
+
+        search.sync_index(restaurants)
+        self.imported += len(restaurants)
@@ -0,0 +1,158 @@
+import re
+import unicodedata
+from django.db import connection
+from django.db.models import BooleanField, F, FloatField, Func, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+# ===============================================
+# 店舗の全文検索
+# 店名/説明/市区町村/カテゴリ名をn-gram（2文字ずつ）に分割した検索用文書をRestaurant.search_documentに保存しておき、
+# PostgreSQLではGINインデックス(to_tsvector)、SQLiteではFTS5の仮想テーブルで検索する。
+# ===============================================
+FTS_TABLE = 'nagoyameshi_restaurant_fts'
+
+# to_tsvector/to_tsqueryの設定。分割は自前で行うので、語幹処理などをしない'simple'を使う
+TS_CONFIG = 'simple'
+
+WORD_SPLIT = re.compile(r'[\W_]+')
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+def split_words(text):
+    return [word for word in WORD_SPLIT.split(normalize(text)) if word]
+
+def ngrams(word, n=2):
+    if len(word) <= n:
+        return [word]
+    return [word[i:i + n] for i in range(len(word) - n + 1)]
+
+def tokenize(*texts):
+    '''
+    文字列を検索用のトークン（2文字ずつのn-gram）に分割する
+    '''
+    tokens = []
+    for text in texts:
+        for word in split_words(text):
+            tokens.extend(ngrams(word))
+    return tokens
+
+def build_document(name, description, city, category_name):
+    return ' '.join(tokenize(name, description, city, category_name))
+
+# ===============================================
+# 検索用文書の更新
+# ===============================================
+def is_fts5():
+    return connection.vendor == 'sqlite'
+
+def is_postgresql():
+    return connection.vendor == 'postgresql'
+
+def update_document(restaurant):
+    '''
+    店舗の検索用文書を作り直す（保存はしない）
+    '''
+    restaurant.search_document = build_document(restaurant.name, restaurant.description, restaurant.city, restaurant.category_id.name)
+
+def sync_index(restaurants):
+    '''
+    SQLiteの場合、FTS5のテーブルに検索用文書を反映する
+    '''
+    if not is_fts5():
+        return
+    rows = [(restaurant.pk, restaurant.search_document) for restaurant in restaurants]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk, ) for pk, _ in rows])
+        cursor.executemany(f'INSERT INTO {FTS_TABLE}(rowid, document) VALUES (%s, %s)', rows)
+
+def remove_from_index(pk):
+    if not is_fts5():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [pk])
+
+def clear_index():
+    if not is_fts5():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+def rebuild_index(restaurants, batch_size=1000):
+    '''
+    すべての店舗の検索用文書を作り直し、件数を返す
+    '''
+    count = 0
+    batch = []
+    for restaurant in restaurants.select_related('category_id').iterator(chunk_size=batch_size):
+        update_document(restaurant)
+        batch.append(restaurant)
+        if len(batch) >= batch_size:
+            count += _save_documents(restaurants.model, batch)
+            batch = []
+    if batch:
+        count += _save_documents(restaurants.model, batch)
+    return count
+
+def _save_documents(model, restaurants):
+    model.objects.bulk_update(restaurants, ['search_document'])
+    sync_index(restaurants)
+    return len(restaurants)
+
+# ===============================================
+# 検索
+# ===============================================
+def build_tsquery(keyword):
+    '''
+    キーワードをto_tsquery用の文字列にする（すべてのn-gramを含む店舗が対象）
+    1文字の語は前方一致で検索する
+    '''
+    terms = []
+    for word in split_words(keyword):
+        if len(word) == 1:
+            terms.append(f"'{word}':*")
+        else:
+            terms.extend(f"'{token}'" for token in ngrams(word))
+    return ' & '.join(terms)
+
+def build_fts5_query(keyword):
+    '''
+    キーワードをFTS5のMATCH用の文字列にする
+    '''
+    terms = []
+    for word in split_words(keyword):
+        if len(word) == 1:
+            terms.append(f'"{word}"*')
+        else:
+            terms.extend(f'"{token}"' for token in ngrams(word))
+    return ' AND '.join(terms)
+
+def search_restaurants(queryset, keyword):
+    '''
+    キーワードに一致する店舗に絞り込み、関連度をscoreとして付与する（大きいほど関連度が高い）
+    '''
+    if not split_words(keyword):
+        return queryset.with_score()
+
+    if is_postgresql():
+        vector = Func(Value(TS_CONFIG), F('search_document'), function='to_tsvector')
+        query = Func(Value(TS_CONFIG), Value(build_tsquery(keyword)), function='to_tsquery')
+        matches = Func(vector, query, template='%(expressions)s', arg_joiner=' @@ ', output_field=BooleanField())
+        rank = Cast(Func(vector, query, function='ts_rank'), FloatField())
+        return queryset.filter(matches).annotate(score=rank)
+
+    if is_fts5():
+        query = build_fts5_query(keyword)
+        table = queryset.model._meta.db_table
+        pk_column = queryset.model._meta.pk.column
+        matches = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [query])
+        # bm25()は関連度が高いほど小さい値を返すので符号を反転する
+        rank = RawSQL(f'SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = "{table}"."{pk_column}"', [query], output_field=FloatField())
+        return queryset.filter(pk__in=matches).annotate(score=rank)
+
+    # 全文検索に対応していないDBの場合は部分一致で検索する
+    query = Q()
+    for word in split_words(keyword):
+        query &= Q(name__icontains=word) | Q(description__icontains=word) | Q(city__icontains=word) | Q(category_id__name__icontains=word)
+    return queryset.filter(query).with_score()
@@ -0,0 +1,198 @@
+from django.db.models import F
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
+from django.db.backends.signals import connection_created
+from django.db import transaction
+from django.dispatch import receiver
+from .models import Category, Favorite, Reservation, ReservationSlot, Restaurant, RestaurantPhoto, Review
+from . import custom_context, search, thumbnails
+from .middleware import clear_page_cache, install_query_recorder
+
+# ===============================================
+# レビューの集計値（星の数の合計/件数）を店舗に反映する
+# ===============================================
+@receiver(pre_save, sender=Review)
+def review_pre_save_callback(sender, instance, raw, **kwargs):
+    # 編集の場合、変更前の店舗と星の数を記録しておく
+    instance._previous_rating = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_rating = Review.objects.filter(pk=instance.pk).values_list('restaurant_id', 'number_of_stars').first()
+
+@receiver(post_save, sender=Review)
+def review_post_save_callback(sender, instance, created, raw, **kwargs):
+    # loaddataの場合は店舗側の値もそのまま読み込まれるので何もしない
+    if raw:
+        return
+
+    previous = getattr(instance, '_previous_rating', None)
+
+    if previous is None:
+        # 新規投稿
+        Restaurant.objects.filter(pk=instance.restaurant_id_id).update(
+            stars_sum=F('stars_sum') + instance.number_of_stars,
+            reviews_count=F('reviews_count') + 1,
+        )
+        return
+
+    previous_restaurant_id, previous_stars = previous
+
+    if previous_restaurant_id == instance.restaurant_id_id:
+        # 同じ店舗の場合、星の数の差分だけ反映する
+        if previous_stars != instance.number_of_stars:
+            Restaurant.objects.filter(pk=instance.restaurant_id_id).update(
+                stars_sum=F('stars_sum') + instance.number_of_stars - previous_stars,
+            )
+        return
+
+    # 店舗が変わった場合、元の店舗から取り除いて新しい店舗に加える
+    Restaurant.objects.filter(pk=previous_restaurant_id).update(
+        stars_sum=F('stars_sum') - previous_stars,
+        reviews_count=F('reviews_count') - 1,
+    )
+    Restaurant.objects.filter(pk=instance.restaurant_id_id).update(
+        stars_sum=F('stars_sum') + instance.number_of_stars,
+        reviews_count=F('reviews_count') + 1,
+    )
+
+@receiver(post_delete, sender=Review)
+def review_post_delete_callback(sender, instance, **kwargs):
+    Restaurant.objects.filter(pk=instance.restaurant_id_id).update(
+        stars_sum=F('stars_sum') - instance.number_of_stars,
+        reviews_count=F('reviews_count') - 1,
+    )
+
+# ===============================================
+# 全文検索用の文書を更新する
+# ===============================================
+@receiver(pre_save, sender=Restaurant)
+def restaurant_pre_save_callback(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    search.update_document(instance)
+
+@receiver(post_save, sender=Restaurant)
+def restaurant_post_save_callback(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    search.sync_index([instance])
+
+@receiver(post_delete, sender=Restaurant)
+def restaurant_post_delete_callback(sender, instance, **kwargs):
+    search.remove_from_index(instance.pk)
+
+@receiver(post_save, sender=Category)
+def category_post_save_callback(sender, instance, raw, **kwargs):
+    # カテゴリ名が変わった場合に備えて、カテゴリ内の店舗の文書を作り直す
+    if raw:
+        return
+    search.rebuild_index(Restaurant.objects.filter(category_id=instance))
+
+# ===============================================
+# アップロードされた画像のサムネイルを作成する
+# ===============================================
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=RestaurantPhoto)
+def image_post_save_callback(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    thumbnails.update_thumbnails(instance)
+
+# ===============================================
+# カテゴリ一覧のキャッシュを破棄する
+# ===============================================
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_cache_callback(sender, instance, **kwargs):
+    # コミット前に他のリクエストが古い一覧をキャッシュし直す場合があるので、コミット後にも破棄する
+    custom_context.clear_categories_cache()
+    transaction.on_commit(custom_context.clear_categories_cache)
+
+    # ヘッダーのカテゴリ一覧が変わるので、ページキャッシュも破棄する
+    transaction.on_commit(clear_page_cache)
+
+# ===============================================
+# お気に入りの店舗IDのキャッシュを破棄する
+# ===============================================
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def favorite_cache_callback(sender, instance, **kwargs):
+    # 管理画面やユーザー/店舗の削除（CASCADE）による変更も含める。
+    # コミット前に他のリクエストが古い値をキャッシュし直す場合があるので、コミット後にも破棄する
+    user_id = instance.user_id_id
+    custom_context.clear_favorites_cache(user_id)
+    transaction.on_commit(lambda: custom_context.clear_favorites_cache(user_id))
+
+# ===============================================
+# ユーザー情報（ユーザー名/サブスクの状態など）が変わったら、そのユーザーのページキャッシュを破棄する
+# ===============================================
+@receiver(post_save, sender=get_user_model())
+def user_post_save_callback(sender, instance, **kwargs):
+    transaction.on_commit(lambda: clear_page_cache([instance.pk]))
+
+# ===============================================
+# 予約枠の残り座席数を更新する
+# ===============================================
+@receiver(pre_save, sender=Reservation)
+def reservation_pre_save_callback(sender, instance, raw, **kwargs):
+    # 変更の場合、変更前の予約内容を記録しておく
+    instance._previous_reservation = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_reservation = Reservation.objects.filter(pk=instance.pk).values_list('restaurant_id', 'reservation_datetime', 'number_of_persons').first()
+
+@receiver(post_save, sender=Reservation)
+def reservation_post_save_callback(sender, instance, raw, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, '_previous_reservation', None)
+    if previous is not None:
+        previous_restaurant_id, previous_datetime, previous_persons = previous
+        ReservationSlot.objects.release(previous_restaurant_id, previous_datetime, previous_persons)
+
+    # 座席数のチェックはReservation.clean()で行い、ここでは残り座席数を記録するだけにする
+    if instance.restaurant_id.capacity is not None:
+        ReservationSlot.objects.reserve(instance.restaurant_id, instance.reservation_datetime, instance.number_of_persons)
+
+@receiver(post_delete, sender=Reservation)
+def reservation_post_delete_callback(sender, instance, **kwargs):
+    ReservationSlot.objects.release(instance.restaurant_id_id, instance.reservation_datetime, instance.number_of_persons)
+
+# 予約枠の作り方が変わる項目
+SLOT_FIELDS = ('capacity', 'opening_time', 'closing_time')
+
+@receiver(pre_save, sender=Restaurant)
+def restaurant_slot_pre_save_callback(sender, instance, raw, **kwargs):
+    # 変更の場合、変更前の座席数/営業時間を記録しておく
+    instance._previous_slot_fields = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_slot_fields = Restaurant.objects.filter(pk=instance.pk).values_list(*SLOT_FIELDS).first()
+
+@receiver(post_save, sender=Restaurant)
+def restaurant_slot_post_save_callback(sender, instance, raw, created, **kwargs):
+    # 座席数/営業時間が変わった場合、作成済みの予約枠を予約から作り直す
+    if raw or created:
+        return
+    previous = getattr(instance, '_previous_slot_fields', None)
+    if previous is not None and previous != tuple(getattr(instance, name) for name in SLOT_FIELDS):
+        ReservationSlot.objects.rebuild(instance)
+
+@receiver(m2m_changed, sender=Restaurant.regular_closing_day.through)
+def restaurant_closing_day_callback(sender, instance, action, reverse, pk_set, **kwargs):
+    # 定休日が変わった場合も、作成済みの予約枠を作り直す
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        ReservationSlot.objects.rebuild(instance)
+    elif pk_set:
+        for restaurant in Restaurant.objects.filter(pk__in=pk_set, capacity__isnull=False):
+            ReservationSlot.objects.rebuild(restaurant)
+
+# ===============================================
+# リクエストごとのSQLの計測（QueryMetricsMiddleware）のため、DB接続にexecute_wrapperを追加する
+# ===============================================
+@receiver(connection_created)
+def connection_created_callback(sender, connection, **kwargs):
+    install_query_recorder(connection)
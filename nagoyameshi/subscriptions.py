@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .middleware import clear_page_cache
+import stripe
+
+# ===============================================
+# Stripeクライアント
+# ===============================================
+class StripeClient:
+    '''
+    Stripe APIを呼び出すクライアント
+    '''
+    def list_subscriptions(self, customer_id):
+        subscriptions = stripe.Subscription.list(customer=customer_id)
+        return [
+            {'status': subscription.status, 'current_period_end': subscription.current_period_end}
+            for subscription in subscriptions.auto_paging_iter()
+        ]
+
+    async def alist_subscriptions(self, customer_id):
+        '''
+        list_subscriptions()の非同期版（ASGIで、Stripeの応答を待つ間にスレッドを占有しない）
+        '''
+        page = await stripe.Subscription.list_async(customer=customer_id)
+        subscriptions = []
+        while True:
+            subscriptions += [
+                {'status': subscription.status, 'current_period_end': subscription.current_period_end}
+                for subscription in page.data
+            ]
+            if not page.has_more:
+                return subscriptions
+            page = await page.next_page_async()
+
+class FakeStripeClient:
+    '''
+    テスト用のStripeクライアント。外部には問い合わせず、subscriptionsに登録した内容を返す
+    '''
+    # カスタマーID -> [{'status':..., 'current_period_end':...}, ...]
+    subscriptions = {}
+    # list_subscriptions()が呼ばれたカスタマーIDの記録
+    calls = []
+
+    @classmethod
+    def reset(cls):
+        cls.subscriptions = {}
+        cls.calls = []
+
+    def list_subscriptions(self, customer_id):
+        self.calls.append(customer_id)
+        if customer_id not in self.subscriptions:
+            raise stripe.error.InvalidRequestError('No such customer: %s' % customer_id, 'customer')
+        return self.subscriptions[customer_id]
+
+    async def alist_subscriptions(self, customer_id):
+        return self.list_subscriptions(customer_id)
+
+def get_stripe_client():
+    return import_string(settings.STRIPE_CLIENT)()
+
+# ===============================================
+# サブスクの状態のキャッシュ
+# ===============================================
+def get_subscription_expires_at(status, current_period_end=None):
+    '''
+    記録したサブスクの状態の有効期限を返す。
+    アクティブなら、次にStripeへ問い合わせるのはTTL経過後か、契約期間の終了時のどちらか早い方。
+    アクティブでなければ（契約期間が終わっていても）TTLの間は問い合わせない
+    '''
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=settings.SUBSCRIPTION_STATE_TTL)
+    if status == 'active' and current_period_end:
+        period_end = datetime.fromtimestamp(current_period_end, tz=dt_timezone.utc)
+        expires_at = min(expires_at, max(period_end, now))
+    return expires_at
+
+def set_subscription_state(user, status, current_period_end=None):
+    '''
+    サブスクの状態をユーザーに記録する
+    '''
+    user.subscription_status = status
+    user.subscription_expires_at = get_subscription_expires_at(status, current_period_end)
+    user.save(update_fields=['subscription_status', 'subscription_expires_at'])
+
+def clear_customer(user):
+    '''
+    無効なカスタマーIDとサブスクの状態を削除する
+    '''
+    user.customer_id = ""
+    user.subscription_status = None
+    user.subscription_expires_at = None
+    user.save(update_fields=['customer_id', 'subscription_status', 'subscription_expires_at'])
+
+def select_subscription(subscriptions):
+    '''
+    アクティブなサブスクがあればそれを、なければ最初のサブスクを返す
+    '''
+    active = [subscription for subscription in subscriptions if subscription['status'] == 'active']
+    if active:
+        return active[0]
+    if subscriptions:
+        return subscriptions[0]
+    return {'status': 'none', 'current_period_end': None}
+
+def refresh_subscription_state(user):
+    '''
+    Stripeに問い合わせて、サブスクの状態を更新する
+    '''
+    try:
+        subscriptions = get_stripe_client().list_subscriptions(user.customer_id)
+    except stripe.error.InvalidRequestError:
+        print("このカスタマーIDは無効です。")
+        clear_customer(user)
+        return
+    except stripe.error.StripeError:
+        # 通信エラーなどの場合は記録済みの状態をそのまま使う
+        print("Stripeへの問い合わせに失敗しました。")
+        return
+
+    subscription = select_subscription(subscriptions)
+    set_subscription_state(user, subscription['status'], subscription['current_period_end'])
+
+async def arefresh_subscription_state(user):
+    '''
+    refresh_subscription_state()の非同期版
+    '''
+    try:
+        subscriptions = await get_stripe_client().alist_subscriptions(user.customer_id)
+    except stripe.error.InvalidRequestError:
+        print("このカスタマーIDは無効です。")
+        await sync_to_async(clear_customer)(user)
+        return
+    except stripe.error.StripeError:
+        print("Stripeへの問い合わせに失敗しました。")
+        return
+
+    subscription = select_subscription(subscriptions)
+    await sync_to_async(set_subscription_state)(user, subscription['status'], subscription['current_period_end'])
+
+def check_subscription_state(user):
+    '''
+    サブスクが有効ならTrue、無効ならFalseを返す。
+    記録済みの状態が期限内であればStripeには問い合わせない
+    '''
+    # 未ログイン、またはカスタマーIDがない場合false
+    if not user.is_authenticated or not user.customer_id:
+        return False
+
+    if user.is_subscription_state_expired():
+        refresh_subscription_state(user)
+
+    return user.has_active_subscription()
+
+async def acheck_subscription_state(user):
+    '''
+    check_subscription_state()の非同期版。userは request.auser() で読み込んだユーザー
+    '''
+    if not user.is_authenticated or not user.customer_id:
+        return False
+
+    if user.is_subscription_state_expired():
+        await arefresh_subscription_state(user)
+
+    return user.has_active_subscription()
+
+# ===============================================
+# webhookで受け取ったイベントの処理
+# ===============================================
+def is_handled_event(event_type):
+    return event_type == 'checkout.session.completed' or event_type.startswith('customer.subscription.')
+
+def parse_event(event):
+    '''
+    イベントの内容を検証して、購入完了なら('checkout', ユーザーID, カスタマーID)、
+    サブスクの作成/更新/削除なら('subscription', カスタマーID, サブスクの辞書)を返す。不正な内容ならValueError
+    '''
+    payload = event.payload
+    if not isinstance(payload, dict):
+        raise ValueError('イベントの内容が不正です。')
+
+    if event.type == 'checkout.session.completed':
+        if not payload.get('client_reference_id') or not payload.get('customer'):
+            return None
+        try:
+            user_id = uuid.UUID(str(payload['client_reference_id']))
+        except ValueError:
+            raise ValueError(f'client_reference_idが不正です: {payload["client_reference_id"]}')
+        return 'checkout', user_id, payload['customer']
+
+    for key in ('id', 'customer', 'status'):
+        if not payload.get(key):
+            raise ValueError(f'{key}がありません。')
+    return 'subscription', payload['customer'], {
+        'id': payload['id'], 'status': payload['status'], 'current_period_end': payload.get('current_period_end'),
+    }
+
+def process_stripe_events(batch_size=100):
+    '''
+    未処理のイベントを古い順にbatch_size件まとめて処理し、処理した件数を返す。
+    同じユーザーへの更新はまとめて反映し、bulk_updateで書き込む。
+    内容が不正なイベントは処理済みにしてerrorに理由を記録する
+    '''
+    from .models import StripeEvent
+    User = get_user_model()
+
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True)
+            .order_by('stripe_created', 'id')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        # ユーザーID -> カスタマーID（購入完了）
+        customer_ids = {}
+        # カスタマーID -> {サブスクID: サブスクの辞書}（同じサブスクは最後のイベントの内容）
+        subscriptions = {}
+        for event in events:
+            try:
+                parsed = parse_event(event)
+            except ValueError as e:
+                event.error = str(e)
+                continue
+            if parsed is None:
+                continue
+
+            kind, key, value = parsed
+            if kind == 'checkout':
+                customer_ids[key] = value
+            else:
+                subscriptions.setdefault(key, {})[value['id']] = value
+
+        # 購入完了したユーザーにカスタマーIDを記録する（状態は次のチェック時に取得し直す）
+        users = list(User.objects.filter(pk__in=customer_ids.keys()))
+        for user in users:
+            user.customer_id = customer_ids[user.pk]
+            user.subscription_expires_at = None
+        User.objects.bulk_update(users, ['customer_id', 'subscription_expires_at'])
+        user_ids = [user.pk for user in users]
+
+        # サブスクの作成/更新/削除をユーザーに記録する。
+        # 同じカスタマーに複数のサブスクがあればアクティブなものを優先する
+        users = list(User.objects.filter(customer_id__in=subscriptions.keys()))
+        for user in users:
+            subscription = select_subscription(list(subscriptions[user.customer_id].values()))
+            user.subscription_status = subscription['status']
+            if subscription['status'] == 'active':
+                user.subscription_expires_at = get_subscription_expires_at(subscription['status'], subscription['current_period_end'])
+            else:
+                # このバッチに含まれない別のサブスクが有効な場合があるので、次のチェック時にStripeに確認する
+                user.subscription_expires_at = None
+        User.objects.bulk_update(users, ['subscription_status', 'subscription_expires_at'])
+        user_ids += [user.pk for user in users]
+
+        now = timezone.now()
+        for event in events:
+            event.processed_at = now
+        StripeEvent.objects.bulk_update(events, ['processed_at', 'error'])
+
+        # bulk_updateではシグナルが送られないので、更新したユーザーのページキャッシュをここで破棄する
+        transaction.on_commit(lambda: clear_page_cache(user_ids))
+
+    return len(events)
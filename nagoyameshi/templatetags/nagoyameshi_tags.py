@@ -0,0 +1,47 @@
+from django import template
+from nagoyameshi.models import split_stars
+from nagoyameshi import thumbnails
+
+register = template.Library()
+
+@register.filter
+def stars(avg):
+    '''
+    星の数の平均値を星の表示用の辞書に変換するフィルタ
+    '''
+    return split_stars(avg)
+
+@register.filter
+def srcset(instance, ext='jpg'):
+    '''
+    画像のサムネイルのsrcset（{{ restaurant|srcset:"webp" }}）
+    '''
+    return thumbnails.get_srcset(instance, ext)
+
+@register.filter
+def thumbnail(instance, width):
+    '''
+    指定した幅以上で最小のサムネイルのURL（{{ photo|thumbnail:320 }}）
+    '''
+    return thumbnails.get_thumbnail_url(instance, int(width))
+
+@register.inclusion_tag('nagoyameshi/partials/responsive_image.html')
+def responsive_image(instance, sizes='100vw', css_class='', alt=''):
+    '''
+    WebP/JPEGのサムネイルから、表示幅(sizes)に合った画像を選ばせる<picture>を出力する
+    '''
+    return {
+        'src': instance.image.url,
+        'webp_srcset': thumbnails.get_srcset(instance, 'webp'),
+        'jpg_srcset': thumbnails.get_srcset(instance, 'jpg'),
+        'sizes': sizes,
+        'css_class': css_class,
+        'alt': alt,
+    }
+
+@register.filter
+def is_favorite(restaurant, favorite_ids):
+    '''
+    お気に入りの店舗かどうか（{{ restaurant|is_favorite:FAVORITE_RESTAURANT_IDS }}）
+    '''
+    return restaurant.pk in favorite_ids
@@ -1,3 +1,1211 @@
-from django.test import TestCase
+from datetime import time as dt_time, timedelta
+import csv
+import hashlib
+import hmac
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+import json
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from unittest import mock, skipUnless
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from PIL import Image
+from config.asgi import StaticFilesApplication
+from . import custom_context, models, reservation_export, restaurant_io, search, thumbnails
+from .pagination import encode_cursor, paginate_by_keyset
+from .middleware import QueryMetricsMiddleware, clear_page_cache
+from .subscriptions import FakeStripeClient, process_stripe_events
+import stripe
 
-# Create your tests here.
+User = get_user_model()
+
+
+def create_restaurant(**kwargs):
+    category, _ = models.Category.objects.get_or_create(name='和食')
+    values = {
+        'name': '店舗', 'category_id': category, 'description': '説明',
+        'floor_price': 1000, 'maximum_price': 3000,
+        'opening_time': dt_time(10), 'closing_time': dt_time(22),
+        'postal_code': '460-0001', 'city': '名古屋市中区', 'street_address': '1-1',
+        'phone_number': '0521234567',
+    }
+    values.update(kwargs)
+    return models.Restaurant.objects.create(**values)
+
+
+# ===============================================
+# レビューの集計値（星の数の合計/件数）
+# ===============================================
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.restaurant = create_restaurant()
+        self.other_restaurant = create_restaurant(name='別の店舗')
+
+    def create_review(self, restaurant, stars):
+        return models.Review.objects.create(restaurant_id=restaurant, user_id=self.user, number_of_stars=stars, comment='おいしい', visited_date=timezone.localdate())
+
+    def assertRating(self, restaurant, stars_sum, reviews_count):
+        restaurant.refresh_from_db()
+        self.assertEqual((restaurant.stars_sum, restaurant.reviews_count), (stars_sum, reviews_count))
+
+    def test_create_and_delete(self):
+        review = self.create_review(self.restaurant, 4)
+        self.create_review(self.restaurant, 2)
+        self.assertRating(self.restaurant, 6, 2)
+        self.assertEqual(self.restaurant.stars_avg(), 3)
+
+        review.delete()
+        self.assertRating(self.restaurant, 2, 1)
+
+    def test_change_stars(self):
+        review = self.create_review(self.restaurant, 4)
+        review.number_of_stars = 1
+        review.save()
+        self.assertRating(self.restaurant, 1, 1)
+
+        # 星の数が変わらない保存では値は変わらない
+        review.comment = 'まあまあ'
+        review.save()
+        self.assertRating(self.restaurant, 1, 1)
+
+    def test_move_to_other_restaurant(self):
+        review = self.create_review(self.restaurant, 4)
+        self.create_review(self.restaurant, 3)
+        review.restaurant_id = self.other_restaurant
+        review.number_of_stars = 5
+        review.save()
+        self.assertRating(self.restaurant, 3, 1)
+        self.assertRating(self.other_restaurant, 5, 1)
+
+    def test_rebuild_command(self):
+        self.create_review(self.restaurant, 4)
+        self.create_review(self.restaurant, 5)
+        self.create_review(self.other_restaurant, 1)
+        # 集計値がずれた状態から作り直す
+        models.Restaurant.objects.update(stars_sum=100, reviews_count=100)
+        empty = create_restaurant(name='レビューなし')
+        models.Restaurant.objects.filter(pk=empty.pk).update(stars_sum=3, reviews_count=1)
+
+        stdout = StringIO()
+        call_command('rebuild_rating_aggregates', stdout=stdout)
+        self.assertIn('3件', stdout.getvalue())
+        self.assertRating(self.restaurant, 9, 2)
+        self.assertRating(self.other_restaurant, 1, 1)
+        self.assertRating(empty, 0, 0)
+
+
+# ===============================================
+# 店舗一覧のクエリ数
+# ===============================================
+class TopQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.client.force_login(self.user)
+        self.url = reverse('nagoyameshi:top')
+        self.add_restaurants(1)
+
+    def add_restaurants(self, count):
+        for i in range(count):
+            restaurant = create_restaurant(name=f'店舗{models.Restaurant.objects.count()}')
+            models.Review.objects.create(restaurant_id=restaurant, user_id=self.user, number_of_stars=4, comment='おいしい', visited_date=timezone.localdate())
+            models.Favorite.objects.create(restaurant_id=restaurant, user_id=self.user)
+
+    def get(self):
+        # 一覧が変わってもページキャッシュを使わずに表示させる
+        clear_page_cache()
+        return self.client.get(self.url)
+
+    def test_query_count_does_not_depend_on_restaurants(self):
+        # カテゴリ一覧のキャッシュを作っておく
+        self.get()
+        with CaptureQueriesContext(connection) as one_restaurant:
+            self.get()
+
+        self.add_restaurants(5)
+        with self.assertNumQueries(len(one_restaurant)):
+            response = self.get()
+        self.assertEqual(len(response.context['restaurants']), 6)
+        # 評価（集計列）はレビューを読み込まずに表示する
+        self.assertFalse(any('nagoyameshi_review' in query['sql'] for query in one_restaurant.captured_queries))
+
+
+# ===============================================
+# サブスクの状態のキャッシュ
+# ===============================================
+@override_settings(STRIPE_CLIENT='nagoyameshi.subscriptions.FakeStripeClient', STRIPE_WEBHOOK_SECRET='whsec_test')
+class SubscriptionStateTests(TestCase):
+    def setUp(self):
+        FakeStripeClient.reset()
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password', customer_id='cus_1')
+        self.restaurant = create_restaurant()
+        self.client.force_login(self.user)
+
+    def test_state_is_cached_until_expiry(self):
+        FakeStripeClient.subscriptions['cus_1'] = [{'status': 'active', 'current_period_end': int(time.time()) + 86400}]
+
+        for _ in range(3):
+            response = self.client.get(reverse('nagoyameshi:review_form', kwargs={'pk': self.restaurant.pk}))
+            self.assertTemplateUsed(response, 'nagoyameshi/review_form.html')
+
+        self.assertEqual(FakeStripeClient.calls, ['cus_1'])
+
+    def test_expired_state_is_refreshed(self):
+        FakeStripeClient.subscriptions['cus_1'] = [{'status': 'canceled', 'current_period_end': int(time.time())}]
+        User.objects.filter(pk=self.user.pk).update(subscription_status='active', subscription_expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self.client.get(reverse('nagoyameshi:review_form', kwargs={'pk': self.restaurant.pk}))
+
+        self.assertTemplateUsed(response, 'nagoyameshi/premium_inactive.html')
+        self.assertEqual(FakeStripeClient.calls, ['cus_1'])
+
+    def test_inactive_state_is_cached_after_period_end(self):
+        FakeStripeClient.subscriptions['cus_1'] = [{'status': 'past_due', 'current_period_end': int(time.time()) - 60}]
+
+        for _ in range(3):
+            response = self.client.get(reverse('nagoyameshi:review_form', kwargs={'pk': self.restaurant.pk}))
+            self.assertTemplateUsed(response, 'nagoyameshi/premium_inactive.html')
+
+        self.assertEqual(FakeStripeClient.calls, ['cus_1'])
+
+    def test_unknown_customer_is_cleared(self):
+        response = self.client.get(reverse('nagoyameshi:review_form', kwargs={'pk': self.restaurant.pk}))
+
+        self.assertTemplateUsed(response, 'nagoyameshi/premium_inactive.html')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.customer_id, '')
+
+    def post_webhook(self, event, secret='whsec_test'):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse('nagoyameshi:webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def subscription_event(self, event_id, status, created):
+        return {
+            'id': event_id, 'object': 'event', 'type': 'customer.subscription.updated', 'created': created,
+            'data': {'object': {'id': 'sub_1', 'object': 'subscription', 'customer': 'cus_1', 'status': status, 'current_period_end': int(time.time()) + 86400}},
+        }
+
+    def test_webhook_updates_state(self):
+        response = self.post_webhook(self.subscription_event('evt_1', 'active', 1))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(process_stripe_events(), 1)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.has_active_subscription())
+        self.assertFalse(self.user.is_subscription_state_expired())
+
+    def test_webhook_is_idempotent_and_applies_latest_event(self):
+        self.post_webhook(self.subscription_event('evt_2', 'canceled', 2))
+        self.post_webhook(self.subscription_event('evt_1', 'active', 1))
+        self.post_webhook(self.subscription_event('evt_2', 'canceled', 2))
+
+        self.assertEqual(models.StripeEvent.objects.count(), 2)
+        self.assertEqual(process_stripe_events(), 2)
+        self.assertEqual(process_stripe_events(), 0)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscription_status, 'canceled')
+
+    def test_webhook_links_customer_on_checkout(self):
+        user = User.objects.create_user(username='new', email='new@example.com', password='password')
+        self.post_webhook({
+            'id': 'evt_3', 'object': 'event', 'type': 'checkout.session.completed', 'created': 3,
+            'data': {'object': {'id': 'cs_1', 'object': 'checkout.session', 'client_reference_id': str(user.pk), 'customer': 'cus_2'}},
+        })
+
+        process_stripe_events()
+        user.refresh_from_db()
+        self.assertEqual(user.customer_id, 'cus_2')
+
+    def test_invalid_event_does_not_block_batch(self):
+        self.post_webhook({
+            'id': 'evt_bad', 'object': 'event', 'type': 'checkout.session.completed', 'created': 1,
+            'data': {'object': {'id': 'cs_1', 'object': 'checkout.session', 'client_reference_id': 'not-a-uuid', 'customer': 'cus_2'}},
+        })
+        self.post_webhook(self.subscription_event('evt_1', 'active', 2))
+
+        self.assertEqual(process_stripe_events(), 2)
+        self.assertIn('client_reference_id', models.StripeEvent.objects.get(event_id='evt_bad').error)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.has_active_subscription())
+
+    def test_active_subscription_wins_over_old_deleted_one(self):
+        self.post_webhook(self.subscription_event('evt_1', 'active', 1))
+        old = self.subscription_event('evt_2', 'canceled', 2)
+        old['type'] = 'customer.subscription.deleted'
+        old['data']['object']['id'] = 'sub_old'
+        self.post_webhook(old)
+
+        process_stripe_events()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscription_status, 'active')
+
+    def test_inactive_subscription_is_rechecked(self):
+        self.post_webhook(self.subscription_event('evt_1', 'canceled', 1))
+
+        process_stripe_events()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscription_status, 'canceled')
+        self.assertTrue(self.user.is_subscription_state_expired())
+
+    def test_webhook_rejects_invalid_signature(self):
+        response = self.post_webhook({'id': 'evt_1', 'type': 'customer.subscription.updated'}, secret='whsec_wrong')
+
+        self.assertEqual(response.status_code, 400)
+
+
+# ===============================================
+# インデックスの利用（実行計画）
+# ===============================================
+@skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'EXPLAINの形式がPostgreSQL/SQLite用のため')
+class QueryPlanTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.restaurant = create_restaurant()
+
+    def explain(self, queryset):
+        # テスト用の少ない行数ではシーケンシャルスキャンが選ばれるため、PostgreSQLでは無効にしておく
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = self.explain(queryset)
+        self.assertIn(index_name, plan, plan)
+
+    def test_category_name(self):
+        self.assertUsesIndex(models.Category.objects.filter(name='和食'), 'category_name_idx')
+
+    def test_restaurant_price(self):
+        self.assertUsesIndex(models.Restaurant.objects.filter(floor_price__gte=1000), 'restaurant_floor_price_idx')
+        self.assertUsesIndex(models.Restaurant.objects.filter(maximum_price__lte=3000), 'restaurant_maximum_price_idx')
+
+    def test_restaurant_category_and_price(self):
+        queryset = models.Restaurant.objects.filter(category_id=self.restaurant.category_id, floor_price__gte=1000, maximum_price__lte=3000)
+        self.assertUsesIndex(queryset, 'restaurant_category_price_idx')
+
+    def test_favorite_lookup(self):
+        queryset = models.Favorite.objects.filter(user_id=self.user, restaurant_id=self.restaurant)
+        self.assertUsesIndex(queryset, '_uniq')
+
+    def test_reservation_range(self):
+        now = timezone.now()
+        queryset = models.Reservation.objects.filter(user_id=self.user, reservation_datetime__gte=now, reservation_datetime__lte=now + timedelta(hours=2))
+        self.assertUsesIndex(queryset, 'reservation_user_datetime_idx')
+
+
+# ===============================================
+# 店舗の全文検索
+# ===============================================
+class SearchTests(TestCase):
+    def setUp(self):
+        self.restaurant = create_restaurant(name='味噌カツの店', description='名古屋名物の味噌カツ', city='名古屋市中区')
+        self.other_restaurant = create_restaurant(name='ひつまぶし', description='うなぎ料理', city='名古屋市熱田区')
+
+    def search(self, keyword):
+        queryset = search.search_restaurants(models.Restaurant.objects.all(), keyword)
+        return [restaurant.pk for restaurant in queryset.order_by('-score', '-pk')]
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize('味噌カツ'), ['味噌', '噌カ', 'カツ'])
+        # 全角/大文字は正規化し、記号や空白で語を分ける
+        self.assertEqual(search.tokenize('ＡＢＣ Cafe!', 'a'), ['ab', 'bc', 'ca', 'af', 'fe', 'a'])
+        self.assertEqual(search.tokenize('', None, '!!'), [])
+
+    def test_migration_document_matches(self):
+        # マイグレーションにコピーした処理と同じ文書を作る
+        migration = importlib.import_module('nagoyameshi.migrations.0005_restaurant_search_document')
+        texts = ('味噌カツの店', '名古屋名物！ ＡＢＣ', '名古屋市中区', '和食')
+        self.assertEqual(migration.build_document(*texts), search.build_document(*texts))
+
+    def test_partial_match(self):
+        for keyword in ('味噌カツ', '味噌', 'カツ', '味', '中区 味噌'):
+            with self.subTest(keyword=keyword):
+                self.assertEqual(self.search(keyword), [self.restaurant.pk])
+        self.assertEqual(self.search('うなぎ'), [self.other_restaurant.pk])
+        self.assertEqual(self.search('味噌うなぎ'), [])
+
+    def test_quotes_and_operators_are_escaped(self):
+        # 引用符や記号は構文として解釈されない
+        for keyword in ('"味噌', "味噌'", '味噌*', '(味噌) & !', 'カツ:*'):
+            with self.subTest(keyword=keyword):
+                self.assertEqual(self.search(keyword), [self.restaurant.pk])
+        # AND/OR/NOTなどの演算子も通常の語として検索する（エラーにならない）
+        for keyword in ("味噌' OR 1=1 --", '味噌 AND', 'NOT カツ', 'カツ | うなぎ', 'カツ NEAR うなぎ'):
+            with self.subTest(keyword=keyword):
+                self.assertEqual(self.search(keyword), [])
+        # 記号だけのキーワードは絞り込まない
+        self.assertEqual(len(self.search('"* ! ()')), 2)
+
+    def test_ranking(self):
+        # キーワードを多く含む店舗ほど上位になる
+        better = create_restaurant(name='カツ丼', description='カツ定食とカツサンド')
+        self.assertEqual(self.search('カツ'), [better.pk, self.restaurant.pk])
+
+    def test_index_follows_save_and_delete(self):
+        self.restaurant.name = 'きしめん'
+        self.restaurant.description = '平打ちの麺'
+        self.restaurant.save()
+        self.assertEqual(self.search('味噌'), [])
+        self.assertEqual(self.search('きしめん'), [self.restaurant.pk])
+
+        # カテゴリ名の変更も反映する
+        category = self.restaurant.category_id
+        category.name = '麺類'
+        category.save()
+        self.assertEqual(sorted(self.search('麺類')), sorted([self.restaurant.pk, self.other_restaurant.pk]))
+
+        pk = self.restaurant.pk
+        self.restaurant.delete()
+        self.assertEqual(self.search('きしめん'), [])
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT COUNT(*) FROM {search.FTS_TABLE} WHERE rowid = %s', [pk])
+                self.assertEqual(cursor.fetchone()[0], 0)
+
+
+# ===============================================
+# 予約の重複/座席数のチェック
+# ===============================================
+class ReservationAvailabilityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.other = User.objects.create_user(username='other', email='other@example.com', password='password')
+        self.restaurant = create_restaurant(capacity=4)
+        self.other_restaurant = create_restaurant(name='別の店舗')
+        tomorrow = timezone.localtime() + timedelta(days=1)
+        self.noon = tomorrow.replace(hour=12, minute=0, second=0, microsecond=0)
+
+    def reserve(self, user, restaurant, reservation_datetime, number_of_persons=2, save=True):
+        reservation = models.Reservation(user_id=user, restaurant_id=restaurant, reservation_datetime=reservation_datetime, number_of_persons=number_of_persons)
+        reservation.full_clean()
+        if save:
+            reservation.save()
+        return reservation
+
+    def test_user_cannot_reserve_within_interval(self):
+        self.reserve(self.user, self.other_restaurant, self.noon)
+
+        with self.assertRaises(ValidationError):
+            self.reserve(self.user, self.restaurant, self.noon + timedelta(hours=1), save=False)
+
+    def test_other_users_do_not_block(self):
+        self.reserve(self.other, self.other_restaurant, self.noon)
+
+        self.reserve(self.user, self.other_restaurant, self.noon)
+
+    def test_capacity(self):
+        self.reserve(self.other, self.restaurant, self.noon, number_of_persons=3)
+
+        with self.assertRaises(ValidationError):
+            self.reserve(self.user, self.restaurant, self.noon + timedelta(minutes=30), number_of_persons=2, save=False)
+        self.reserve(self.user, self.restaurant, self.noon + timedelta(hours=2), number_of_persons=2)
+
+    def test_availability_is_one_query(self):
+        with self.assertNumQueries(1):
+            models.Reservation.objects.availability(self.user, self.restaurant, self.noon)
+
+    def test_slots_follow_reservations(self):
+        reservation = self.reserve(self.other, self.restaurant, self.noon, number_of_persons=3)
+        slots = models.ReservationSlot.objects.covering(self.restaurant, self.noon)
+        self.assertEqual(set(slots.values_list('remaining', flat=True)), {1})
+
+        reservation.delete()
+        self.assertEqual(set(slots.values_list('remaining', flat=True)), {4})
+
+    def test_save_outside_the_view_only_records_seats(self):
+        # 座席数のチェックはclean()で行い、clean()を通さずに保存しても例外にはならない
+        self.reserve(self.other, self.restaurant, self.noon, number_of_persons=3)
+        models.Reservation.objects.create(user_id=self.user, restaurant_id=self.restaurant, reservation_datetime=self.noon, number_of_persons=2)
+
+        slots = models.ReservationSlot.objects.covering(self.restaurant, self.noon)
+        self.assertEqual(set(slots.values_list('remaining', flat=True)), {0})
+
+    def test_reservation_without_slot_is_rejected(self):
+        # 予約枠がない日時は、座席数のチェックを通さない
+        reservation = models.Reservation(user_id=self.user, restaurant_id=self.restaurant, reservation_datetime=self.noon, number_of_persons=2)
+        with mock.patch.object(models.ReservationSlotQuerySet, 'ensure'):
+            with self.assertRaises(ValidationError):
+                reservation.full_clean()
+
+    def test_first_reservation_of_the_day_creates_slots(self):
+        models.Reservation.objects.create(user_id=self.user, restaurant_id=self.restaurant, reservation_datetime=self.noon, number_of_persons=3)
+
+        slots = models.ReservationSlot.objects.covering(self.restaurant, self.noon)
+        self.assertEqual(set(slots.values_list('remaining', flat=True)), {1})
+
+    def test_editing_full_reservation_excludes_itself(self):
+        reservation = self.reserve(self.other, self.restaurant, self.noon, number_of_persons=4)
+
+        reservation.comment = '窓際の席'
+        reservation.full_clean()
+        reservation.save()
+        reservation.reservation_datetime = self.noon + timedelta(minutes=30)
+        reservation.full_clean()
+        reservation.save()
+
+        reservation.number_of_persons = 5
+        with self.assertRaises(ValidationError):
+            reservation.full_clean()
+
+    def test_capacity_change_rebuilds_slots(self):
+        self.reserve(self.other, self.restaurant, self.noon, number_of_persons=3)
+        slots = models.ReservationSlot.objects.covering(self.restaurant, self.noon)
+
+        self.restaurant.capacity = 6
+        self.restaurant.save()
+        self.assertEqual(set(slots.values_list('capacity', 'remaining')), {(6, 3)})
+
+        self.restaurant.capacity = 2
+        self.restaurant.save()
+        self.assertEqual(set(slots.values_list('capacity', 'remaining')), {(2, 0)})
+
+        # 予約済みの人数より減らしてから戻しても、予約から数え直す
+        self.restaurant.capacity = 6
+        self.restaurant.save()
+        self.assertEqual(set(slots.values_list('capacity', 'remaining')), {(6, 3)})
+
+    def test_opening_hours_and_closing_days_rebuild_slots(self):
+        self.reserve(self.other, self.restaurant, self.noon, number_of_persons=3)
+
+        # 営業時間を延ばすと、延ばした時間の予約枠も作成される
+        self.restaurant.closing_time = dt_time(23)
+        self.restaurant.save()
+        late = self.noon.replace(hour=22, minute=30)
+        self.assertTrue(models.ReservationSlot.objects.covering(self.restaurant, late).exists())
+        self.assertEqual(set(models.ReservationSlot.objects.covering(self.restaurant, self.noon).values_list('remaining', flat=True)), {1})
+
+        # 定休日にすると、その曜日の予約枠は削除される
+        day, _ = models.Day.objects.get_or_create(key=self.noon.weekday(), defaults={'name': '曜日'})
+        self.restaurant.regular_closing_day.add(day)
+        self.assertFalse(models.ReservationSlot.objects.filter(restaurant_id=self.restaurant, start__date=self.noon.date()).exists())
+
+    def test_availability_month_is_limited(self):
+        self.client.force_login(self.user)
+        url = reverse('nagoyameshi:reservation_availability', kwargs={'pk': self.restaurant.pk})
+        today = timezone.localdate()
+
+        for month in ('1990-05', '9999-12', '2500-01', f'{today.year}-13', 'abc'):
+            self.assertEqual(self.client.get(url, {'month': month}).status_code, 400, month)
+        self.assertFalse(models.ReservationSlot.objects.exists())
+
+        response = self.client.get(url, {'month': f'{today.year}-{today.month:02}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(models.ReservationSlot.objects.filter(start__date__lt=today).exists())
+
+
+# ===============================================
+# カテゴリ一覧のキャッシュ
+# ===============================================
+class CategoriesCacheTests(TestCase):
+    def setUp(self):
+        custom_context.clear_categories_cache()
+        models.Category.objects.create(name='和食')
+
+    def test_warm_cache_renders_without_queries(self):
+        custom_context.categories_list(None)
+
+        with self.assertNumQueries(0):
+            categories = custom_context.categories_list(None)['CATEGORIES_LIST']
+        self.assertEqual([category.name for category in categories], ['和食'])
+
+    def test_save_and_delete_invalidate(self):
+        custom_context.categories_list(None)
+
+        category = models.Category.objects.create(name='洋食')
+        self.assertEqual(len(custom_context.get_categories()), 2)
+
+        category.delete()
+        self.assertEqual(len(custom_context.get_categories()), 1)
+
+
+# ===============================================
+# ページキャッシュ
+# ===============================================
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        custom_context.clear_categories_cache()
+        self.url = reverse('nagoyameshi:index')
+
+    def test_anonymous_page_is_served_from_cache(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(second.content, first.content)
+
+        not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_category_change_invalidates(self):
+        self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Category.objects.create(name='洋食')
+        self.assertContains(self.client.get(self.url), '洋食')
+
+    @override_settings(STRIPE_CLIENT='nagoyameshi.subscriptions.FakeStripeClient')
+    def test_premium_member_page_is_not_cached(self):
+        FakeStripeClient.reset()
+        user = User.objects.create_user(username='user', email='user@example.com', password='password', customer_id='cus_1')
+        user.subscription_status = 'active'
+        user.subscription_expires_at = timezone.now() + timedelta(hours=1)
+        user.save()
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('nagoyameshi:premium'))
+        self.assertNotIn('ETag', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+
+# ===============================================
+# 店舗詳細/レビュー一覧の条件付きGET
+# ===============================================
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.restaurant = create_restaurant()
+        self.url = reverse('nagoyameshi:review_list', kwargs={'pk': self.restaurant.pk})
+        self.client.force_login(self.user)
+
+    def test_unchanged_page_returns_304(self):
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.content)
+
+    def test_csrf_cookie_and_subscription_change_etag(self):
+        etag = self.client.get(self.url)['ETag']
+
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = 'a' * 32
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        User.objects.filter(pk=self.user.pk).update(subscription_status='canceled')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_new_review_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        models.Review.objects.create(restaurant_id=self.restaurant, user_id=self.user, number_of_stars=4, comment='おいしい', visited_date=timezone.localdate())
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_category_rename_changes_etag(self):
+        custom_context.clear_categories_cache()
+        etag = self.client.get(self.url)['ETag']
+
+        category = self.restaurant.category_id
+        category.name = '洋食'
+        with self.captureOnCommitCallbacks(execute=True):
+            category.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '洋食')
+
+
+# ===============================================
+# サムネイル
+# ===============================================
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+    def upload(self, size=(800, 600)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        restaurant = create_restaurant()
+        restaurant.image.save('photo.jpg', ContentFile(buffer.getvalue()))
+        restaurant.refresh_from_db()
+        return restaurant
+
+    def test_thumbnails_are_generated_on_upload(self):
+        restaurant = self.upload()
+        self.assertEqual([thumbnail['width'] for thumbnail in restaurant.thumbnails['files']], [320, 640])
+        self.assertTrue(restaurant.image.storage.exists(restaurant.thumbnails['files'][0]['webp']))
+        self.assertIn('640w', thumbnails.get_srcset(restaurant, 'jpg'))
+        self.assertIn('800w', thumbnails.get_srcset(restaurant, 'jpg'))
+        self.assertTrue(thumbnails.get_thumbnail_url(restaurant, 100).endswith('_320.jpg'))
+
+    def test_urls_use_saved_names(self):
+        # ストレージが別の名前で保存した場合も、その名前でURLを作る
+        storage = models.Restaurant._meta.get_field('image').storage
+        with mock.patch.object(FileSystemStorage, 'get_available_name', lambda self, name, max_length=None: name.replace('.', '_renamed.')):
+            restaurant = self.upload()
+
+        for thumbnail in restaurant.thumbnails['files']:
+            for ext in ('webp', 'jpg'):
+                self.assertIn('_renamed.', thumbnail[ext])
+                self.assertTrue(storage.exists(thumbnail[ext]))
+                self.assertIn(storage.url(thumbnail[ext]), thumbnails.get_srcset(restaurant, ext))
+        self.assertEqual(thumbnails.get_thumbnail_url(restaurant, 100), storage.url(restaurant.thumbnails['files'][0]['jpg']))
+
+    def test_shared_default_image_is_generated_once(self):
+        # 既定の画像は店舗ごとに作り直さず、他の店舗が使っているサムネイルを削除しない
+        storage = models.Restaurant._meta.get_field('image').storage
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'gray').save(buffer, 'PNG')
+        storage.save('nagoyameshi/noimage.png', ContentFile(buffer.getvalue()))
+
+        first = create_restaurant()
+        first.refresh_from_db()
+        self.assertEqual(len(first.thumbnails['files']), 2)
+
+        with mock.patch.object(FileSystemStorage, 'delete') as delete, mock.patch.object(FileSystemStorage, 'save') as save:
+            second = create_restaurant()
+        save.assert_not_called()
+        delete.assert_not_called()
+        second.refresh_from_db()
+        self.assertEqual(second.thumbnails, first.thumbnails)
+
+        # 作り直しても、他の店舗が使っているファイルは残る
+        thumbnails.update_thumbnails(second, force=True)
+        second.refresh_from_db()
+        self.assertNotEqual(second.thumbnails['files'], first.thumbnails['files'])
+        for thumbnail in first.thumbnails['files'] + second.thumbnails['files']:
+            self.assertTrue(storage.exists(thumbnail['jpg']))
+
+    def test_decompression_bomb_falls_back_to_original(self):
+        # 画素数が多すぎる画像はサムネイルを作らず、元画像だけを使う
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            restaurant = self.upload()
+
+        self.assertEqual(restaurant.thumbnails['files'], [])
+        self.assertEqual(thumbnails.get_srcset(restaurant, 'jpg'), '')
+        self.assertEqual(thumbnails.get_thumbnail_url(restaurant, 100), restaurant.image.url)
+
+
+# ===============================================
+# 店舗のインポート/エクスポート
+# ===============================================
+class RestaurantImportExportTests(TestCase):
+    def setUp(self):
+        models.Category.objects.create(name='和食')
+        models.Day.objects.create(name='月曜日', key=1)
+
+    def test_import_and_export(self):
+        row = {
+            'name': '店舗', 'category': '和食', 'description': '説明', 'floor_price': 1000, 'maximum_price': 3000,
+            'opening_time': '10:00', 'closing_time': '22:00', 'postal_code': '460-0001', 'city': '名古屋市中区',
+            'street_address': '1-1', 'phone_number': '0521234567', 'capacity': 20, 'regular_closing_day': ['月曜日'],
+        }
+        lines = [json.dumps(row), json.dumps(dict(row, phone_number='bad')), json.dumps(dict(row, category='洋食'))]
+
+        importer = restaurant_io.RestaurantImporter(chunk_size=1)
+        importer.run(restaurant_io.read_rows(StringIO('\n'.join(lines)), 'jsonl'))
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([line_num for line_num, _ in importer.errors], [2, 3])
+
+        restaurant = models.Restaurant.objects.get()
+        self.assertEqual(list(restaurant.regular_closing_day.values_list('name', flat=True)), ['月曜日'])
+        self.assertIsNotNone(restaurant.created_at)
+        self.assertTrue(restaurant.search_document)
+
+        output = StringIO()
+        restaurant_io.write_rows(output, 'csv', restaurant_io.export_rows(models.Restaurant.objects.all()))
+        rows = list(restaurant_io.read_rows(StringIO(output.getvalue()), 'csv'))
+        self.assertEqual(rows[0][1]['regular_closing_day'], ['月曜日'])
+        self.assertEqual(rows[0][1]['phone_number'], '0521234567')
+
+    def test_failed_chunk_is_rolled_back_and_skipped(self):
+        row = {
+            'name': '店舗', 'category': '和食', 'description': '説明', 'floor_price': 1000, 'maximum_price': 3000,
+            'opening_time': '10:00', 'closing_time': '22:00', 'postal_code': '460-0001', 'city': '名古屋市中区',
+            'street_address': '1-1', 'phone_number': '0521234567', 'regular_closing_day': ['月曜日'],
+        }
+        lines = [json.dumps(dict(row, name=f'店舗{i}')) for i in range(6)]
+
+        # 2つ目のまとまり（3〜4行目）の保存中にDBのエラーが起きても、他のまとまりは登録する
+        sync_index = search.sync_index
+        def failing_sync_index(restaurants):
+            sync_index(restaurants)
+            if restaurants[0].name == '店舗2':
+                raise IntegrityError('duplicate key')
+
+        importer = restaurant_io.RestaurantImporter(chunk_size=2)
+        with mock.patch.object(search, 'sync_index', failing_sync_index):
+            importer.run(restaurant_io.read_rows(StringIO('\n'.join(lines)), 'jsonl'))
+
+        self.assertEqual(importer.imported, 4)
+        self.assertEqual([line_num for line_num, _ in importer.errors], [3])
+        self.assertIn('4行目までの2件', importer.errors[0][1])
+        self.assertEqual(sorted(models.Restaurant.objects.values_list('name', flat=True)), ['店舗0', '店舗1', '店舗4', '店舗5'])
+        self.assertEqual(models.Restaurant.regular_closing_day.through.objects.count(), 4)
+        self.assertEqual(models.ExtendedModel.objects.filter(restaurant__isnull=True, category__isnull=True).count(), 0)
+
+
+# ===============================================
+# 予約のCSVエクスポート
+# ===============================================
+class ReservationExportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', email='staff@example.com', password='password', is_staff=True)
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.restaurant = create_restaurant()
+        self.other_restaurant = create_restaurant(name='別の店舗')
+        noon = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days, restaurant in ((1, self.restaurant), (2, self.restaurant), (40, self.restaurant), (1, self.other_restaurant)):
+            models.Reservation.objects.create(user_id=self.user, restaurant_id=restaurant, reservation_datetime=noon + timedelta(days=days), number_of_persons=2)
+        self.url = reverse('nagoyameshi:reservation_export')
+        self.date_from = (noon + timedelta(days=1)).date()
+
+    def test_staff_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_streams_filtered_rows(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url, {
+            'restaurant': self.restaurant.pk,
+            'from': self.date_from.isoformat(),
+            'to': (self.date_from + timedelta(days=7)).isoformat(),
+        })
+        self.assertTrue(response.streaming)
+
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual(rows[0][0], '予約ID')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual({row[5] for row in rows[1:]}, {'店舗'})
+        self.assertEqual(rows[1][6], 'user')
+
+    async def test_streams_asynchronously_under_asgi(self):
+        # ASGIでは非同期イテレータで、chunk_rows行ずつ読み込んで送信する
+        await self.async_client.aforce_login(self.staff)
+        with mock.patch.object(reservation_export, 'ASYNC_CHUNK_ROWS', 2):
+            response = await self.async_client.get(self.url)
+            self.assertTrue(response.is_async)
+
+            chunks = [chunk async for chunk in response.streaming_content]
+
+        # BOM+ヘッダー、予約4件を2行ずつ
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.reader(StringIO(b''.join(chunks).decode('utf-8-sig'))))
+        self.assertEqual(rows[0][0], '予約ID')
+        self.assertEqual(len(rows), 5)
+
+
+# ===============================================
+# マイページのクエリ数
+# ===============================================
+class MypageQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password', customer_id='cus_1')
+        self.client.force_login(self.user)
+        self.url = reverse('nagoyameshi:mypage')
+
+    def add_rows(self, count):
+        tomorrow = timezone.now() + timedelta(days=1)
+        for i in range(count):
+            restaurant = create_restaurant(name=f'店舗{models.Restaurant.objects.count()}')
+            models.Favorite.objects.create(user_id=self.user, restaurant_id=restaurant)
+            models.Reservation.objects.create(user_id=self.user, restaurant_id=restaurant, reservation_datetime=tomorrow + timedelta(hours=i), number_of_persons=2)
+
+    def test_query_count_does_not_depend_on_rows(self):
+        self.add_rows(1)
+        # カテゴリ一覧のキャッシュを作っておく
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as one_row:
+            self.client.get(self.url)
+
+        self.add_rows(5)
+        with self.assertNumQueries(len(one_row)):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['favorites']), 6)
+        self.assertEqual(len(response.context['reservations']), 6)
+
+
+# ===============================================
+# レビュー一覧のクエリ数
+# ===============================================
+class ReviewListQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.restaurant = create_restaurant()
+        self.client.force_login(self.user)
+        self.url = reverse('nagoyameshi:review_list', kwargs={'pk': self.restaurant.pk})
+
+    def add_reviews(self, count):
+        for i in range(count):
+            author = User.objects.create_user(username=f'author{User.objects.count()}', email=f'author{User.objects.count()}@example.com', password='password')
+            models.Review.objects.create(restaurant_id=self.restaurant, user_id=author, number_of_stars=3, comment='おいしい', visited_date=timezone.localdate())
+
+    def test_query_count_does_not_depend_on_reviews(self):
+        self.add_reviews(1)
+        # カテゴリ一覧のキャッシュを作っておく
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as one_review:
+            self.client.get(self.url)
+
+        self.add_reviews(5)
+        with self.assertNumQueries(len(one_review)):
+            response = self.client.get(self.url)
+        self.assertContains(response, 'author6')
+
+
+# ===============================================
+# キーセットページネーション
+# ===============================================
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+        self.client.force_login(self.user)
+        self.factory = RequestFactory()
+
+    def create_rated_restaurants(self, ratings):
+        restaurants = []
+        for i, (stars_sum, reviews_count) in enumerate(ratings):
+            restaurant = create_restaurant(name=f'店舗{i}')
+            models.Restaurant.objects.filter(pk=restaurant.pk).update(stars_sum=stars_sum, reviews_count=reviews_count)
+            restaurants.append(restaurant)
+        return restaurants
+
+    def walk(self, queryset, ordering, per_page):
+        '''
+        最初のページから次のページをたどり、ページごとのpkのリストを返す
+        '''
+        pages = []
+        query = ''
+        while True:
+            page = paginate_by_keyset(self.factory.get('/?' + query), queryset, ordering, per_page)
+            pages.append([obj.pk for obj in page])
+            if not page.has_next:
+                return pages
+            query = page.next_query
+
+    def test_page_boundary(self):
+        self.create_rated_restaurants([(3, 1)] * 4)
+        queryset = models.Restaurant.objects.with_score()
+
+        # ちょうどper_page件なら次のページはない
+        self.assertEqual([len(page) for page in self.walk(queryset, ['-score', '-pk'], 4)], [4])
+        # per_page+1件目は次のページに入る
+        self.assertEqual([len(page) for page in self.walk(queryset, ['-score', '-pk'], 3)], [3, 1])
+
+    def test_ties_are_ordered_by_pk(self):
+        # 平均が同じ店舗が複数あっても、pkで順番が決まり重複/欠落しない
+        restaurants = self.create_rated_restaurants([(4, 1), (8, 2), (0, 0), (9, 2), (12, 3), (5, 1), (0, 0)])
+        queryset = models.Restaurant.objects.with_score()
+        pages = self.walk(queryset, ['-score', '-pk'], 2)
+
+        restaurants = models.Restaurant.objects.filter(pk__in=[r.pk for r in restaurants])
+        expected = sorted(restaurants, key=lambda r: (r.stars_avg(), r.pk), reverse=True)
+        self.assertEqual(sum(pages, []), [r.pk for r in expected])
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+
+    def test_score_does_not_aggregate_reviews(self):
+        self.create_rated_restaurants([(3, 1)])
+        query = str(models.Restaurant.objects.with_rating().with_score().order_by('-score', '-pk').query)
+        self.assertNotIn('GROUP BY', query)
+        self.assertNotIn('nagoyameshi_review', query)
+
+    def test_invalid_cursor_is_first_page(self):
+        restaurant = create_restaurant()
+        cursors = [
+            encode_cursor(['abc', 1]),
+            encode_cursor([None, None]),
+            encode_cursor([{}, 1]),
+            encode_cursor([1.0, 'abc']),
+            encode_cursor([1.0]),
+            encode_cursor({'score': 1}),
+            'not-base64!',
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('nagoyameshi:top'), {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.context['page'].is_first)
+                self.assertEqual([r.pk for r in response.context['restaurants']], [restaurant.pk])
+
+                response = self.client.get(reverse('nagoyameshi:review_list', kwargs={'pk': restaurant.pk}), {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.context['page'].is_first)
+
+
+# ===============================================
+# お気に入り登録/解除（JSON）
+# ===============================================
+class FavoriteToggleTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password', customer_id='cus_1')
+        self.user.subscription_status = 'active'
+        self.user.subscription_expires_at = timezone.now() + timedelta(hours=1)
+        self.user.save()
+        self.restaurant = create_restaurant()
+        self.client.force_login(self.user)
+        self.url = reverse('nagoyameshi:favorite_toggle', kwargs={'pk': self.restaurant.pk})
+
+    def test_toggle_is_one_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url)
+        self.assertEqual(response.json()['favorite'], True)
+        self.assertTrue(models.Favorite.objects.filter(user_id=self.user, restaurant_id=self.restaurant).exists())
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'DELETE'))]
+        self.assertEqual(len(writes), 1, writes)  # INSERTだけ（post_deleteのシグナルがあるので、DELETEは対象を読み込んでから行う）
+
+        response = self.client.post(self.url)
+        self.assertEqual(response.json()['favorite'], False)
+        self.assertFalse(models.Favorite.objects.exists())
+
+    def test_free_member_and_missing_restaurant(self):
+        self.assertEqual(self.client.post(reverse('nagoyameshi:favorite_toggle', kwargs={'pk': self.restaurant.pk + 100})).status_code, 404)
+
+        self.user.customer_id = None
+        self.user.save()
+        self.assertEqual(self.client.post(self.url).status_code, 403)
+        self.assertFalse(models.Favorite.objects.exists())
+
+    def test_detail_post_redirects(self):
+        response = self.client.post(reverse('nagoyameshi:restaurant_detail', kwargs={'pk': self.restaurant.pk}))
+        self.assertRedirects(response, reverse('nagoyameshi:restaurant_detail', kwargs={'pk': self.restaurant.pk}), fetch_redirect_response=False)
+        self.assertTrue(models.Favorite.objects.exists())
+
+
+# ===============================================
+# 一覧ページのお気に入り表示
+# ===============================================
+class FavoriteBadgeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password', customer_id='cus_1')
+        self.user.subscription_status = 'active'
+        self.user.subscription_expires_at = timezone.now() + timedelta(hours=1)
+        self.user.save()
+        self.client.force_login(self.user)
+        self.restaurants = [create_restaurant(name=f'店舗{i}') for i in range(5)]
+
+    def test_favorite_ids_are_loaded_once_and_invalidated_on_toggle(self):
+        models.Favorite.objects.create(user_id=self.user, restaurant_id=self.restaurants[0])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('nagoyameshi:top'))
+        self.assertEqual(len([query for query in queries if 'nagoyameshi_favorite' in query['sql']]), 1)
+        self.assertContains(response, 'title="お気に入り"', count=1)
+
+        # 2回目は共有キャッシュから読む
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('nagoyameshi:top'))
+        self.assertFalse([query for query in queries if 'nagoyameshi_favorite' in query['sql']])
+
+        self.client.post(reverse('nagoyameshi:favorite_toggle', kwargs={'pk': self.restaurants[1].pk}))
+        self.assertContains(self.client.get(reverse('nagoyameshi:top')), 'title="お気に入り"', count=2)
+
+    def test_favorite_ids_are_invalidated_outside_the_views(self):
+        self.assertContains(self.client.get(reverse('nagoyameshi:top')), 'title="お気に入り"', count=0)
+
+        # 管理画面/シェルでの登録
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Favorite.objects.create(user_id=self.user, restaurant_id=self.restaurants[0])
+            models.Favorite.objects.create(user_id=self.user, restaurant_id=self.restaurants[1])
+        self.assertContains(self.client.get(reverse('nagoyameshi:top')), 'title="お気に入り"', count=2)
+
+        # 店舗の削除（CASCADE）
+        with self.captureOnCommitCallbacks(execute=True):
+            self.restaurants[0].delete()
+        self.assertContains(self.client.get(reverse('nagoyameshi:top')), 'title="お気に入り"', count=1)
+
+
+# ===============================================
+# 非同期のStripe連携ビュー（ローカルの偽のStripeサーバーに問い合わせる）
+# ===============================================
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond(parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()))
+
+    def respond(self, form=None):
+        url = urlsplit(self.path)
+        self.server.requests.append((self.command, url.path, form or parse_qs(url.query)))
+
+        status, body = 404, {'error': {'type': 'invalid_request_error', 'message': 'No such object'}}
+        if self.command == 'POST' and url.path == '/v1/checkout/sessions':
+            status, body = 200, {'id': 'cs_1', 'object': 'checkout.session', 'url': 'https://checkout.example.com/cs_1'}
+        elif url.path == '/v1/checkout/sessions/cs_paid':
+            status, body = 200, {'id': 'cs_paid', 'object': 'checkout.session', 'payment_status': 'paid', 'customer': 'cus_new'}
+        elif url.path == '/v1/billing_portal/sessions':
+            status, body = 200, {'id': 'bps_1', 'object': 'billing_portal.session', 'url': 'https://billing.example.com/bps_1'}
+        elif url.path == '/v1/subscriptions':
+            subscription = {'id': 'sub_1', 'object': 'subscription', 'status': 'active', 'current_period_end': int(time.time()) + 86400}
+            status, body = 200, {'object': 'list', 'url': '/v1/subscriptions', 'has_more': False, 'data': [subscription]}
+
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+class AsyncStripeViewTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStripeHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    def setUp(self):
+        self.server.requests.clear()
+        api_base = stripe.api_base
+        stripe.api_base = f'http://127.0.0.1:{self.server.server_port}'
+        self.addCleanup(setattr, stripe, 'api_base', api_base)
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='password')
+
+    def test_checkout_and_success(self):
+        self.client.force_login(self.user)
+
+        response = self.client.post(reverse('nagoyameshi:checkout'))
+        self.assertRedirects(response, 'https://checkout.example.com/cs_1', fetch_redirect_response=False)
+        method, path, form = self.server.requests[0]
+        self.assertEqual(form['client_reference_id'], [str(self.user.pk)])
+
+        response = self.client.get(reverse('nagoyameshi:success'), {'session_id': 'cs_unknown'})
+        self.assertRedirects(response, reverse('nagoyameshi:index'), fetch_redirect_response=False)
+
+        response = self.client.get(reverse('nagoyameshi:success'), {'session_id': 'cs_paid'})
+        self.assertRedirects(response, reverse('nagoyameshi:premium'), fetch_redirect_response=False)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.customer_id, 'cus_new')
+
+    def test_login_required(self):
+        response = self.client.get(reverse('nagoyameshi:portal'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+        self.assertFalse(self.server.requests)
+
+    async def test_premium_page_refreshes_state_asynchronously(self):
+        self.user.customer_id = 'cus_1'
+        await self.user.asave()
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get(reverse('nagoyameshi:premium'))
+        self.assertTemplateUsed(response, 'nagoyameshi/premium_active.html')
+        self.assertEqual([path for method, path, form in self.server.requests], ['/v1/subscriptions'])
+
+        response = await self.async_client.get(reverse('nagoyameshi:portal'))
+        self.assertRedirects(response, 'https://billing.example.com/bps_1', fetch_redirect_response=False)
+
+
+# ===============================================
+# ASGIでの静的ファイルの配信
+# ===============================================
+class AsgiStaticFilesTests(TestCase):
+    def setUp(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with open(f'{static_root}/app.css', 'wb') as f:
+            f.write(b'a' * 10)
+        self.enterContext(override_settings(STATIC_ROOT=static_root, STATIC_URL='/static/', WHITENOISE_AUTOREFRESH=False, WHITENOISE_USE_FINDERS=False))
+
+    def test_middleware_is_async_capable(self):
+        # 同期専用のミドルウェアがあると、ASGIでもリクエストごとにスレッドで処理される
+        for path in settings.MIDDLEWARE:
+            with self.subTest(middleware=path):
+                self.assertTrue(getattr(import_string(path), 'async_capable', False))
+
+    async def request(self, application, path):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'method': 'GET', 'path': path, 'headers': [], 'query_string': b'',
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        messages = [await communicator.receive_output()]
+        while messages[-1].get('more_body', messages[-1]['type'] == 'http.response.start'):
+            messages.append(await communicator.receive_output())
+        return messages
+
+    async def test_static_files_are_served_before_django(self):
+        async def django_application(scope, receive, send):
+            raise AssertionError('静的ファイルはDjangoを通さない')
+
+        application = StaticFilesApplication(django_application)
+        application.chunk_size = 4
+        start, *body = await self.request(application, '/static/app.css')
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/css; charset="utf-8"'), start['headers'])
+        # ファイルはchunk_sizeずつ送信する
+        self.assertEqual([message['body'] for message in body], [b'aaaa', b'aaaa', b'aa', b''])
+
+
+# ===============================================
+# リクエストごとのSQLの計測
+# ===============================================
+@override_settings(QUERY_COUNT_THRESHOLD=10, QUERY_DUPLICATE_THRESHOLD=3, QUERY_METRICS_SERVER_TIMING=True)
+class QueryMetricsTests(TestCase):
+    def setUp(self):
+        self.restaurants = [create_restaurant(name=f'店舗{i}') for i in range(5)]
+
+    def get(self, view):
+        return QueryMetricsMiddleware(view)(RequestFactory().get('/top/'))
+
+    def test_counts_queries_and_sets_server_timing(self):
+        def view(request):
+            list(models.Restaurant.objects.all())
+            return HttpResponse()
+
+        with self.assertLogs('nagoyameshi.queries', 'DEBUG') as logs:
+            response = self.get(view)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="1 queries", app;dur=[0-9.]+$')
+
+        self.assertEqual(logs.records[0].levelname, 'DEBUG')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['queries'], 1)
+        self.assertEqual(record['duplicates'], [])
+        self.assertFalse(record['threshold_exceeded'])
+
+    def test_flags_duplicate_queries(self):
+        def view(request):
+            # N+1: 店舗ごとにカテゴリを読み込む
+            for restaurant in models.Restaurant.objects.all():
+                restaurant.category_id.name
+            return HttpResponse()
+
+        with self.assertLogs('nagoyameshi.queries', 'DEBUG') as logs:
+            self.get(view)
+
+        self.assertEqual(logs.records[0].levelname, 'WARNING')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['queries'], 6)
+        self.assertEqual(record['duplicates'][0]['count'], 5)
+        self.assertTrue(record['threshold_exceeded'])
+
+    def test_logs_nothing_below_threshold_by_default(self):
+        def view(request):
+            list(models.Restaurant.objects.all())
+            return HttpResponse()
+
+        with self.assertNoLogs('nagoyameshi.queries', 'INFO'):
+            self.get(view)
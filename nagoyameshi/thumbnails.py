@@ -0,0 +1,143 @@
+import posixpath
+from io import BytesIO
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+# ===============================================
+# サムネイル（レスポンシブ画像）
+# アップロードされた画像から、幅ごとのWebP/JPEGを元画像と同じ場所の thumbnails/ に作成する。
+# 作成したサムネイルはモデルの thumbnails に
+# {'name': 元画像, 'width': 元画像の幅, 'files': [{'width': 幅, 'webp': 保存した名前, 'jpg': 保存した名前}, ...]}
+# として記録し、テンプレートではストレージに問い合わせずにsrcsetを組み立てる。
+# ===============================================
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+THUMBNAIL_QUALITY = 80
+
+# 画像のサムネイルを記録するモデル（既定の画像 nagoyameshi/noimage.png は複数の店舗で共有される）
+IMAGE_MODELS = ('nagoyameshi.Restaurant', 'nagoyameshi.RestaurantPhoto')
+
+def get_thumbnail_name(name, width, ext):
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'thumbnails', f'{stem}_{width}.{ext}')
+
+def generate_thumbnails(field_file, replace=True):
+    '''
+    画像のサムネイルを作成し、(元画像の幅, 作成したサムネイルのリスト)を返す。元画像より大きい幅は作らない。
+    replaceがFalseの場合は、作成済みのサムネイルを削除せずに別の名前で保存する
+    '''
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image.load()
+
+    widths = [width for width in THUMBNAIL_WIDTHS if width < image.width]
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+    files = []
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+
+        thumbnail = {'width': width}
+        for ext, image_format in THUMBNAIL_FORMATS.items():
+            # JPEGは透過に対応していないので、WebPだけ透過を残す
+            mode = 'RGBA' if has_alpha and image_format == 'WEBP' else 'RGB'
+            buffer = BytesIO()
+            resized.convert(mode).save(buffer, image_format, quality=THUMBNAIL_QUALITY)
+
+            name = get_thumbnail_name(field_file.name, width, ext)
+            if replace and storage.exists(name):
+                storage.delete(name)
+            # ストレージによっては別の名前で保存されるので、save()が返した名前を記録する
+            thumbnail[ext] = storage.save(name, ContentFile(buffer.getvalue()))
+        files.append(thumbnail)
+
+    return image.width, files
+
+def update_thumbnails(instance, force=False):
+    '''
+    モデル（Restaurant/RestaurantPhoto）の画像が変わっていればサムネイルを作り直す。作り直した場合はTrueを返す
+    '''
+    if not instance.image:
+        return False
+    if not force and instance.thumbnails.get('name') == instance.image.name and 'files' in instance.thumbnails:
+        return False
+
+    # 同じ画像を使う他の行があれば、作成済みのサムネイルをそのまま使う（作成に失敗した記録は使わない）
+    shared = list(get_shared_thumbnails(instance))
+    reusable = [thumbnails for thumbnails in shared if 'files' in thumbnails and thumbnails.get('width') is not None]
+    if reusable and not force:
+        instance.thumbnails = reusable[0]
+    else:
+        try:
+            # 他の行が使っているサムネイルは削除しない
+            width, files = generate_thumbnails(instance.image, replace=not shared)
+        except (OSError, Image.DecompressionBombError):
+            # 画像が読めない/存在しない/大きすぎる場合は元画像だけを使う
+            width, files = None, []
+        instance.thumbnails = {'name': instance.image.name, 'width': width, 'files': files}
+
+    # 保存し直すとシグナルが再び呼ばれるので、updateで書き込む（キャッシュのキーが変わるよう更新日時も変える）
+    type(instance).objects.filter(pk=instance.pk).update(thumbnails=instance.thumbnails, updated_at=timezone.now())
+    return True
+
+def get_shared_thumbnails(instance):
+    '''
+    instance以外で、同じ画像のサムネイルを記録している行のthumbnails
+    '''
+    for label in IMAGE_MODELS:
+        model = apps.get_model(label)
+        rows = model.objects.filter(thumbnails__name=instance.image.name)
+        if isinstance(instance, model):
+            rows = rows.exclude(pk=instance.pk)
+        yield from rows.values_list('thumbnails', flat=True)
+
+def get_files(instance):
+    '''
+    作成済みのサムネイルを幅の小さい順に返す。画像が差し替えられてまだ作成していない場合は空
+    '''
+    thumbnails = instance.thumbnails or {}
+    if thumbnails.get('name') != instance.image.name:
+        return []
+    return sorted(thumbnails.get('files', []), key=lambda thumbnail: thumbnail['width'])
+
+def get_srcset(instance, ext):
+    '''
+    srcset属性の値。JPEGの場合は元画像も最大の候補として含める
+    '''
+    storage = instance.image.storage
+    candidates = [f"{storage.url(thumbnail[ext])} {thumbnail['width']}w" for thumbnail in get_files(instance)]
+
+    width = (instance.thumbnails or {}).get('width')
+    if ext == 'jpg' and candidates and width:
+        candidates.append(f'{instance.image.url} {width}w')
+    return ', '.join(candidates)
+
+def get_thumbnail_url(instance, width):
+    '''
+    width以上で最小のサムネイル（JPEG）のURL。なければ元画像のURL
+    '''
+    for thumbnail in get_files(instance):
+        if thumbnail['width'] >= width:
+            return instance.image.storage.url(thumbnail['jpg'])
+    return instance.image.url
+
+# ===============================================
+# 既存の画像のサムネイルを作成する（generate_thumbnailsコマンドのプロセスプールから呼ばれる）
+# ===============================================
+def init_worker():
+    # spawnで起動された場合に備えて、ワーカープロセスでもDjangoを初期化する
+    import django
+    django.setup()
+
+def process(model_label, pk, force=False):
+    from django.apps import apps
+    model = apps.get_model(model_label)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return False
+    return update_thumbnails(instance, force=force)
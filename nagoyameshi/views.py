@@ -1,14 +1,32 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import add_never_cache_headers
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views import View
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.middleware.csrf import get_token
+from django.utils.decorators import method_decorator
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db.models import Q, Avg
 from . import models, forms
+from . import custom_context
+from .pagination import paginate_by_keyset
+from . import subscriptions
+from . import search
+from . import reservation_export
+from .middleware import has_pending_messages
 from django.contrib.auth import get_user_model
 User = get_user_model()
 from django.contrib import messages
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from django.conf import settings
+from django.db import transaction
 from django.urls import reverse_lazy
+import hashlib
 import stripe
 stripe.api_key  = settings.STRIPE_API_KEY
 
@@ -21,14 +39,27 @@ class IndexView(View):
 
 index = IndexView.as_view()
 
+# ===============================================
+# 非同期ビュー用のログイン必須のMixin
+# Stripeへの問い合わせを待つビューは非同期にし、ASGIで動かすときに待ち時間でワーカーを占有しないようにする
+# ===============================================
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    async def dispatch(self, request, *args, **kwargs):
+        # 非同期ビューではrequest.userを同期的に読み込めないので、先にauser()で読み込んでおく
+        user = await request.auser()
+        request.user = user
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
 # ===============================================
 # サブスク : 購入処理のセッションを生成
 # ===============================================
-class CheckoutView(LoginRequiredMixin, View):
-    def post(self, request, *args, **kwargs):
+class CheckoutView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
 
         # セッションを作る
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await stripe.checkout.Session.create_async(
             line_items=[
                 {
                     'price': settings.STRIPE_PRICE_ID,
@@ -37,6 +68,8 @@ class CheckoutView(LoginRequiredMixin, View):
             ],
             payment_method_types=['card'],
             mode='subscription',
+            # webhookでユーザーとカスタマーIDを紐付けるため、ユーザーIDを渡しておく
+            client_reference_id=str(request.user.id),
             success_url=request.build_absolute_uri(reverse_lazy("nagoyameshi:success")) + '?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=request.build_absolute_uri(reverse_lazy("nagoyameshi:index")),
         )
@@ -50,8 +83,8 @@ checkout = CheckoutView.as_view()
 # ===============================================
 # サブスク : 購入処理の支払い状況を確認
 # ===============================================
-class SuccessView(LoginRequiredMixin, View):
-    def get(self, request, *args, **kwargs):
+class SuccessView(AsyncLoginRequiredMixin, View):
+    async def get(self, request, *args, **kwargs):
 
         # パラメータにセッションIDがあるかチェック
         if "session_id" not in request.GET:
@@ -61,8 +94,8 @@ class SuccessView(LoginRequiredMixin, View):
         # セッションIDが有効であるかチェック
         try:
             checkout_session_id = request.GET['session_id']
-            checkout_session = stripe.checkout.Session.retrieve(checkout_session_id)
-        except:
+            checkout_session = await stripe.checkout.Session.retrieve_async(checkout_session_id)
+        except Exception:
             print("このセッションIDは無効です。")
             return redirect("nagoyameshi:index")
         
@@ -76,8 +109,10 @@ class SuccessView(LoginRequiredMixin, View):
         print("支払い済み")
 
         # 有効であれば、セッションIDからカスタマーIDを取得しユーザーモデルに記録する。
+        # 記録済みのサブスクの状態は破棄し、次のチェック時にStripeから取得し直す。
         request.user.customer_id = checkout_session["customer"]
-        request.user.save()
+        request.user.subscription_expires_at = None
+        await request.user.asave()
 
         print("有料会員登録しました！")
         return redirect("nagoyameshi:premium")
@@ -87,14 +122,14 @@ success = SuccessView.as_view()
 # ===============================================
 # サブスク : ポータルサイトへのリダイレクト
 # ===============================================
-class PortalView(LoginRequiredMixin, View):
-    def get(self, request, *ards, **kwargs):
+class PortalView(AsyncLoginRequiredMixin, View):
+    async def get(self, request, *ards, **kwargs):
 
         if not request.user.customer_id:
             print("有料会員登録されていません")
             return redirect("nagoyameshi:index")
         
-        portalSession = stripe.billing_portal.Session.create(
+        portalSession = await stripe.billing_portal.Session.create_async(
             customer = request.user.customer_id,
             return_url = request.build_absolute_uri(reverse_lazy("nagoyameshi:premium")),
             )
@@ -103,25 +138,55 @@ class PortalView(LoginRequiredMixin, View):
 
 portal = PortalView.as_view()
 
+# ===============================================
+# サブスク : Stripeからのwebhook
+# ===============================================
+@method_decorator(csrf_exempt, name='dispatch')
+class WebhookView(View):
+    def post(self, request, *args, **kwargs):
+
+        # 署名を検証し、Stripeからのリクエストであることを確認する
+        try:
+            event = stripe.Webhook.construct_event(request.body, request.META.get("HTTP_STRIPE_SIGNATURE", ""), settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.error.SignatureVerificationError):
+            print("webhookの署名が無効です。")
+            return HttpResponse(status=400)
+
+        # イベントを記録するだけにして、すぐに応答を返す。
+        # 処理は process_stripe_events コマンドがまとめて行う。同じイベントの再送は無視する。
+        if subscriptions.is_handled_event(event["type"]):
+            models.StripeEvent.objects.bulk_create([
+                models.StripeEvent(event_id=event["id"], type=event["type"], payload=event["data"]["object"], stripe_created=event["created"]),
+            ], ignore_conflicts=True)
+
+        return HttpResponse(status=200)
+
+webhook = WebhookView.as_view()
+
 # ===============================================
 # サブスク : 有料会員登録ページ/有料会員ページ
 # ===============================================
 template_inactive = "nagoyameshi/premium_inactive.html"
 template_active = "nagoyameshi/premium_active.html"
 class PremiumView(View):
-    def get(self, request, *args, **kwargs):
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+
         # サブスクが無効なら非会員のページを表示
-        if not check_subscription_state(request):
-            return render(request, template_inactive)
+        if not await subscriptions.acheck_subscription_state(request.user):
+            return await sync_to_async(render)(request, template_inactive)
 
-        # 有効なら会員のページを表示
-        return render(request, template_active)
+        # 有効なら会員のページを表示（ページキャッシュの対象外）
+        response = await sync_to_async(render)(request, template_active)
+        add_never_cache_headers(response)
+        return response
 
 premium = PremiumView.as_view()
 
 # ===============================================
 # top
 # ===============================================
+RESTAURANTS_PER_PAGE = 15
 class TopView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
 
@@ -134,16 +199,6 @@ class TopView(LoginRequiredMixin, View):
         # floor_price = request.GET.get('floor_price')
         # maximum_price = request.GET.get('maximum_price')
 
-        # 検索キーワードがある場合、検索条件を追加
-        if keyword:
-
-            words = keyword.replace('　', ' ').split()
-
-            for word in words:
-                if word == '':
-                    continue
-                query &= Q(name__icontains=word)
-
         # カテゴリが指定されている場合、検索条件に追加
         if selected_category:
             query &= Q(category_id__name__exact=selected_category)
@@ -162,21 +217,61 @@ class TopView(LoginRequiredMixin, View):
         
 
         # 条件に合致する店舗を検索
-        restaurants = models.Restaurant.objects.filter(query)
+        restaurants = models.Restaurant.objects.listing().filter(query)
+
+        # 検索キーワードがある場合は全文検索で関連度順、ない場合は評価順に並べる
+        if keyword:
+            restaurants = search.search_restaurants(restaurants, keyword)
+        else:
+            restaurants = restaurants.with_score()
+        page = paginate_by_keyset(request, restaurants, ['-score', '-pk'], RESTAURANTS_PER_PAGE)
         
-        context = {'restaurants': restaurants}
+        context = {'restaurants': page.object_list, 'page': page}
         return render(request, 'nagoyameshi/top.html', context)
     
 top = TopView.as_view()
 
+# ===============================================
+# 店舗詳細/レビュー一覧のETag
+# ===============================================
+def restaurant_etag(request, pk, *args, **kwargs):
+    '''
+    店舗/カテゴリ/レビュー/写真/お気に入り/ユーザーの状態が変わらなければ同じ値を返す。
+    一致すればテンプレートをレンダリングせずに304を返す
+    '''
+    # 表示待ちのメッセージはページに含まれるので、304は返さない
+    if has_pending_messages(request):
+        return None
+
+    state = models.Restaurant.objects.filter(pk=pk).page_state(request.user).first()
+    if state is None:
+        return None
+
+    # ページ内のフォームのCSRFトークンはCookieのシークレットごとに異なる（ログインし直すと変わる）。
+    # 初回はここでシークレットを発行し、レスポンスのCookieと同じ値をETagに含める
+    get_token(request)
+
+    user = request.user
+    values = [
+        request.get_full_path(), state, user.pk, user.username, user.customer_id, user.subscription_status,
+        request.META.get('CSRF_COOKIE'),
+        # ヘッダーの検索欄にカテゴリ名の一覧が出るので、カテゴリ名の変更でもETagを変える
+        [category.name for category in custom_context.get_categories()],
+    ]
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+# ブラウザには毎回確認させる（変わっていなければ304）
+restaurant_conditional = [cache_control(private=True, max_age=0), condition(etag_func=restaurant_etag)]
+
 # ===============================================
 # 店舗詳細
 # ===============================================
+@method_decorator(restaurant_conditional, name='get')
 class RestaurantDetailView(LoginRequiredMixin, View):
     def get(self, request, pk, *args, **kwargs):
-        restaurant = models.Restaurant.objects.get(pk=pk)
+        restaurant = models.Restaurant.objects.listing().get(pk=pk)
         photos = models.RestaurantPhoto.objects.filter(restaurant_id=restaurant)
-        favorite = models.Favorite.objects.filter(user_id=request.user, restaurant_id=restaurant).exists()
+        favorite = restaurant.pk in custom_context.get_favorite_ids(request.user)
         context = {'restaurant': restaurant, 'photos':photos, 'favorite':favorite}
 
         return render(request, 'nagoyameshi/restaurant_detail.html', context)
@@ -189,39 +284,51 @@ class RestaurantDetailView(LoginRequiredMixin, View):
         if not check_subscription_state(request):
             return render(request, template_inactive)
         
-        restaurant = models.Restaurant.objects.get(pk=pk)
-        query = Q()
-        query &= Q(user_id = request.user)
-        query &= Q(restaurant_id = models.Restaurant.objects.get(pk=pk))
-        favorite = models.Favorite.objects.filter(query)
-
-        if favorite:
-            # 登録されていれば削除し、お気に入り登録を解除
-            favorite.delete()
-            messages.info(request, 'お気に入り登録を解除しました')
-        else:
-            # 登録されていなければ、お気に入り登録する
-            new_favorite = models.Favorite()
-            new_favorite.restaurant_id = models.Restaurant.objects.get(pk=pk)
-            new_favorite.user_id = request.user
-            new_favorite.save()
-            messages.info(request, 'お気に入りに登録しました')
-
-        favorite = models.Favorite.objects.filter(user_id=request.user, restaurant_id=restaurant).exists()
-        context = {'restaurant': restaurant, 'favorite':favorite}
-        
-        return render(request, 'nagoyameshi/restaurant_detail.html', context)
+        # JavaScriptが無効な場合の送信先。登録/解除して詳細ページに戻る
+        try:
+            favorite = models.Favorite.objects.toggle(request.user, pk)
+        except models.Restaurant.DoesNotExist:
+            return redirect('nagoyameshi:top')
+
+        messages.info(request, get_favorite_message(favorite))
+        return redirect('nagoyameshi:restaurant_detail', pk=pk)
 
 restaurant_detail = RestaurantDetailView.as_view()
 
+# ===============================================
+# お気に入り登録/解除（JSON）
+# ===============================================
+def get_favorite_message(favorite):
+    return 'お気に入りに登録しました' if favorite else 'お気に入り登録を解除しました'
+
+class FavoriteToggleView(LoginRequiredMixin, View):
+    # 未ログインの場合はログインページへのリダイレクトではなく403を返す
+    raise_exception = True
+
+    def post(self, request, pk, *args, **kwargs):
+        if not check_subscription_state(request):
+            return JsonResponse({'error': 'お気に入り機能は有料会員のみ利用できます'}, status=403)
+
+        try:
+            favorite = models.Favorite.objects.toggle(request.user, pk)
+        except models.Restaurant.DoesNotExist:
+            return JsonResponse({'error': '店舗が見つかりません'}, status=404)
+
+        return JsonResponse({'favorite': favorite, 'message': get_favorite_message(favorite)})
+
+favorite_toggle = FavoriteToggleView.as_view()
+
 # ===============================================
 # 店舗ごとのレビュー一覧
 # ===============================================
+REVIEWS_PER_PAGE = 20
+@method_decorator(restaurant_conditional, name='get')
 class ReviewListView(LoginRequiredMixin, View):
     def get(self, request, pk, *args, **kwargs):
-        restaurant = models.Restaurant.objects.get(pk=pk)
-        review_list = models.Review.objects.filter(restaurant_id=pk)
-        context = {'restaurant':restaurant, 'review_list': review_list}
+        restaurant = models.Restaurant.objects.only('name').get(pk=pk)
+        review_list = models.Review.objects.filter(restaurant_id=pk).listing()
+        page = paginate_by_keyset(request, review_list, ['-created_at', '-pk'], REVIEWS_PER_PAGE)
+        context = {'restaurant':restaurant, 'review_list': page.object_list, 'page': page}
         return render(request, 'nagoyameshi/review_list.html', context)
 
 review_list = ReviewListView.as_view()
@@ -344,11 +451,40 @@ review_delete = ReviewDeleteView.as_view()
 # ===============================================
 # マイページ
 # ===============================================
+MYPAGE_RESERVATIONS_LIMIT = 20
+def load_mypage(user):
+    '''
+    マイページの表示内容。お気に入りと今後の予約をそれぞれ1回のSQLで取得し、リストにして返す
+    （件数によらずクエリ数が変わらない）
+    '''
+    # お気に入り/予約は有料会員にしか表示しない
+    if not user.customer_id:
+        return {'favorites': [], 'reservations': [], 'has_more_reservations': False}
+
+    favorites = list(
+        models.Favorite.objects.filter(user_id=user)
+        .select_related('restaurant_id')
+        .only('restaurant_id__name')
+        .order_by('-pk')
+    )
+
+    # 今後の予約を日時の近い順に。1件多く取得して、表示しきれない予約があるかを判定する
+    reservations = list(
+        models.Reservation.objects.filter(user_id=user, reservation_datetime__gte=timezone.now())
+        .select_related('restaurant_id')
+        .only('reservation_datetime', 'number_of_persons', 'comment', 'restaurant_id__name')
+        .order_by('reservation_datetime', 'pk')[:MYPAGE_RESERVATIONS_LIMIT + 1]
+    )
+
+    return {
+        'favorites': favorites,
+        'reservations': reservations[:MYPAGE_RESERVATIONS_LIMIT],
+        'has_more_reservations': len(reservations) > MYPAGE_RESERVATIONS_LIMIT,
+    }
+
 class MypageView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
-        favorites = models.Favorite.objects.filter(user_id=request.user)
-        reservations = models.Reservation.objects.filter(user_id=request.user)
-        context = {'favorites': favorites, 'reservations':reservations}
+        context = load_mypage(request.user)
         return render(request, 'nagoyameshi/mypage.html', context)
 
 mypage = MypageView.as_view()
@@ -387,27 +523,74 @@ class ReservationFormView(LoginRequiredMixin, View):
         print(type(copied['reservation_datetime']))
         print(copied['reservation_datetime'])
 
-        if form.is_valid():
-            # バリデーションOK
-            print('予約完了')
-            form.save()
-            messages.success(request, '予約しました')
-            return redirect('nagoyameshi:restaurant_detail', pk=pk)
-        
-        else:
-            # バリデーションNG
-            values = form.errors.get_json_data().values()
-            for value in values:
-                for v in value:
-                    messages.error(request, v["message"])
+        # 同時に申し込まれても二重予約にならないよう、ロックしてからバリデーションと保存を行う
+        with transaction.atomic():
+            models.lock_for_reservation(request.user, restaurant)
 
-            restaurant = models.Restaurant.objects.get(pk=pk)
-            context = {'restaurant': restaurant, 'form': form}
+            if form.is_valid():
+                # バリデーションOK（座席数のチェックも含む。予約枠の残り座席数は保存時にシグナルで減らす）
+                form.save()
+                print('予約完了')
+                messages.success(request, '予約しました')
+                return redirect('nagoyameshi:restaurant_detail', pk=pk)
 
-            return render(request, 'nagoyameshi/reservation_form.html', context)
+        # バリデーションNG
+        values = form.errors.get_json_data().values()
+        for value in values:
+            for v in value:
+                messages.error(request, v["message"])
+
+        restaurant = models.Restaurant.objects.get(pk=pk)
+        context = {'restaurant': restaurant, 'form': form}
+
+        return render(request, 'nagoyameshi/reservation_form.html', context)
 
 reservation_form = ReservationFormView.as_view()
 
+# ===============================================
+# 予約可能な日時（1か月分）
+# ===============================================
+# 予約状況を表示できるのは今月から何か月先までか（予約枠は表示するときに作成するので、範囲を限る）
+AVAILABILITY_MONTHS_AHEAD = 6
+
+class ReservationAvailabilityView(LoginRequiredMixin, View):
+    def get(self, request, pk, *args, **kwargs):
+        restaurant = models.Restaurant.objects.get(pk=pk)
+
+        # ?month=YYYY-MM（指定がなければ今月）
+        today = timezone.localdate()
+        year, month = today.year, today.month
+        if request.GET.get('month'):
+            try:
+                year, month = [int(v) for v in request.GET['month'].split('-')]
+            except ValueError:
+                return HttpResponseBadRequest('monthはYYYY-MMで指定してください。')
+            if not 0 <= (year - today.year) * 12 + month - today.month <= AVAILABILITY_MONTHS_AHEAD or not 1 <= month <= 12:
+                return HttpResponseBadRequest(f'monthは今月から{AVAILABILITY_MONTHS_AHEAD}か月先までで指定してください。')
+
+        if restaurant.capacity is None:
+            return JsonResponse({'capacity': None, 'slots': [], 'unavailable_dates': []})
+
+        # 月内の予約枠を1回で取得し、空席のない日を求める
+        slots = []
+        available_dates = set()
+        for start, remaining in models.ReservationSlot.objects.for_month(restaurant, year, month).values_list('start', 'remaining'):
+            start = timezone.localtime(start)
+            slots.append({'start': start.isoformat(), 'remaining': remaining})
+            if remaining > 0:
+                available_dates.add(start.date())
+
+        unavailable_dates = []
+        day = datetime(year, month, 1).date()
+        while day.month == month:
+            if day not in available_dates:
+                unavailable_dates.append(day.isoformat())
+            day += timedelta(days=1)
+
+        return JsonResponse({'capacity': restaurant.capacity, 'slots': slots, 'unavailable_dates': unavailable_dates})
+
+reservation_availability = ReservationAvailabilityView.as_view()
+
 # ===============================================
 # 予約変更
 # ===============================================
@@ -417,38 +600,51 @@ class ReservationDeleteView(LoginRequiredMixin, View):
         if not check_subscription_state(request):
             return render(request, template_inactive)
         
-        reservation = models.Reservation.objects.get(pk=pk)
+        try:
+            reservation = models.Reservation.objects.get(pk=pk, user_id=request.user)
+        except models.Reservation.DoesNotExist:
+            return redirect('nagoyameshi:mypage')
+
+        # 予約枠の座席はシグナルで戻される
         reservation.delete()
         return redirect('nagoyameshi:mypage')
     
 reservation_delete = ReservationDeleteView.as_view()
 
+# ===============================================
+# 予約のCSVエクスポート（スタッフ用）
+# ===============================================
+class ReservationExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        # ?restaurant=店舗ID&from=YYYY-MM-DD&to=YYYY-MM-DD（いずれも省略可）
+        try:
+            restaurant_id = int(request.GET['restaurant']) if request.GET.get('restaurant') else None
+            date_from = date.fromisoformat(request.GET['from']) if request.GET.get('from') else None
+            date_to = date.fromisoformat(request.GET['to']) if request.GET.get('to') else None
+        except ValueError:
+            return HttpResponseBadRequest('restaurant/from/toの値が不正です。')
+
+        reservations = reservation_export.filter_reservations(models.Reservation.objects.all(), restaurant_id, date_from, date_to)
+
+        # 全件を読み込まずに、1行ずつ送信する（ASGIでは同期イテレータだとバッファされるので非同期イテレータを渡す）
+        rows = reservation_export.export_rows(reservations)
+        if isinstance(request, ASGIRequest):
+            content = reservation_export.astream_csv(rows)
+        else:
+            content = reservation_export.stream_csv(rows)
+        response = StreamingHttpResponse(content, content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="reservations.csv"'
+        return response
+
+reservation_export_csv = ReservationExportView.as_view()
+
 ########
 
 def check_subscription_state(request):
     '''
     サブスクが有効ならTrue、無効ならFalseを返す
     '''
-    # カスタマーIDがない場合false
-    if not request.user.customer_id:
-        print("カスタマーIDがセットされていません")
-        return False
-
-    # カスタマーIDをもとにStripeに問い合わせ
-    try:
-        subscriptions = stripe.Subscription.list(customer=request.user.customer_id)
-    except:
-        print("このカスタマーIDは無効です。")
-        request.user.customer_id = ""
-        request.user.save()
-        return False
-    
-    # ステータスがアクティブであるかチェック
-    for subscription in subscriptions.auto_paging_iter():
-        if subscription.status == "active":
-            print("サブスクリプションは有効です。")
-            return True
-        else:
-            print("サブスクリプションが無効です。")
-
-    return False
+    return subscriptions.check_subscription_state(request.user)
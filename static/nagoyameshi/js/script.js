@@ -13,4 +13,60 @@ setTimeout( () => {
     for (let message of messages){
         message.remove();
     }
-}, 5000);
\ No newline at end of file
+}, 5000);
+
+//メッセージを表示する（DjangoMessageFrameWorkと同じ見た目）
+const show_message = (text, tag) => {
+    const area      = document.querySelector(".notify_message_area");
+    if (!area){
+        return;
+    }
+    const message   = document.createElement("div");
+    message.className   = `notify_message notify_message_${tag}`;
+
+    const content   = document.createElement("div");
+    content.className   = "notify_message_content";
+    content.textContent = text;
+
+    const close     = document.createElement("div");
+    close.className     = "notify_message_delete";
+    close.innerHTML     = '<i class="fas fa-times"></i>';
+    close.addEventListener("click", () => { message.remove(); });
+
+    message.append(content, close);
+    area.append(message);
+    setTimeout( () => { message.remove(); }, 5000);
+};
+
+//お気に入り登録/解除（ページを再読み込みしない）
+const favorite_forms    = document.querySelectorAll("form[data-favorite-url]");
+for (let favorite_form of favorite_forms){
+    favorite_form.addEventListener("submit", async (event) => {
+        event.preventDefault();
+        const button    = favorite_form.querySelector("button");
+        button.disabled = true;
+
+        try {
+            const response  = await fetch(favorite_form.dataset.favoriteUrl, {
+                method: "POST",
+                headers: {"X-CSRFToken": favorite_form.querySelector("[name=csrfmiddlewaretoken]").value},
+                credentials: "same-origin",
+            });
+            const data      = await response.json();
+            if (!response.ok){
+                show_message(data.error, "error");
+                return;
+            }
+
+            const icon  = favorite_form.querySelector(".favorite_icon");
+            icon.classList.toggle("text-danger", data.favorite);
+            icon.classList.toggle("text-muted", !data.favorite);
+            show_message(data.message, "info");
+        } catch (error) {
+            //通信に失敗した場合は通常の送信で登録/解除する
+            favorite_form.submit();
+        } finally {
+            button.disabled = false;
+        }
+    });
+}